@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+# SmartHomeBot benchmark
+# Times the command path of SmartHomeBot offline, using fake Update, CallbackContext and Bot objects,
+# over several user list sizes, timer counts and config file sizes. Results are written as JSON so
+# runs of different releases can be compared.
+#
+# Usage:
+# python benchmark.py --output benchmark.json
+# python benchmark.py --users 10,1000 --timers 0,100 --compare benchmark.json
+# python benchmark.py --users '' --timers '' --startup 5
+
+import argparse, json, os, platform, subprocess, sys, tempfile, time, logging
+import smarthomebot
+
+owner_id = 1000
+fake_chat_id = -100123
+
+class FakeUser(dict):
+    def __init__(self, user_id):
+        super().__init__(id=user_id, username=f'user{user_id}' if user_id % 2 else None, first_name='First', last_name='Last')
+        self.id = user_id
+
+class FakeMessage(dict):
+    # Telegram objects can be read both as attributes and as dict items
+    def __init__(self, text, user_id, message_id=1):
+        super().__init__(text=text, chat={"id" : user_id})
+        self.text = text
+        self.chat_id = user_id
+        self.message_id = message_id
+        self.from_user = FakeUser(user_id)
+
+class FakeQuery:
+    def __init__(self, data, user_id, message):
+        self.data = data
+        self.from_user = FakeUser(user_id)
+        self.message = message
+
+    def answer(self, text=None) -> None:
+        pass
+
+    def edit_message_text(self, text=None, **kwargs) -> None:
+        pass
+
+class FakeUpdate:
+    def __init__(self, message=None, callback_query=None):
+        self.message = message
+        self.callback_query = callback_query
+
+class FakeContext:
+    def __init__(self):
+        self.args = []
+        self.bot_data = {}
+
+class FakeBot:
+    def __init__(self):
+        self.message_id = 0
+        self.calls = 0
+
+    def send_message(self, chat_id, text, **kwargs) -> FakeMessage:
+        self.calls += 1
+        self.message_id += 1
+        return FakeMessage(text, chat_id, self.message_id)
+
+    def getChatMember(self, chat_id, user_id) -> dict:
+        self.calls += 1
+        return {"user" : FakeUser(user_id)}
+
+def build_config(users, timers) -> dict:
+    user_ids = list(range(owner_id, owner_id + users))
+    now = time.time()
+    timer_entries = [{"id" : n + 1, "label" : '5m', "due" : now + 3600 + n, "owner" : owner_id, "chat_id" : owner_id, "message_id" : n + 1} for n in range(timers)]
+    return {
+        "BOT_DATA" : {"bot_token" : 'bot-token', "bot_id" : 1, "bot_version" : 'benchmark'},
+        "USERS" : {
+            "allowed_users" : user_ids,
+            "admin_users" : user_ids[:max(1, users // 10)],
+            "bot_owner" : [owner_id],
+            "chat_members" : [],
+            "user_requests" : [],
+            "user_rejects" : [],
+            "banned_users" : []
+        },
+        "CHATS" : {"allowed_chats" : fake_chat_id},
+        "TIMERS" : {"missed_policy" : 'fire', "timers" : timer_entries, "alarms" : []}
+    }
+
+def setup_bot(path, users, timers) -> None:
+    # point the bot module at a temp config and fake Bot, no thread or network is started
+    smarthomebot.write_atomic(path, json.dumps(build_config(users, timers), indent=2))
+    smarthomebot.config_file = path
+    smarthomebot.read_config()
+    smarthomebot.bot = FakeBot()
+    smarthomebot.outbound_queue = None
+    smarthomebot.config_writer = None
+    smarthomebot.member_cache = smarthomebot.MemberCache(max_size=2 * users + 16)
+    smarthomebot.render_cache = smarthomebot.RenderCache()
+    smarthomebot.pending_confirmations = smarthomebot.ConfirmationStore()
+    smarthomebot.timer_scheduler = smarthomebot.TimerScheduler(lambda entry: None)
+    smarthomebot.restore_timers()
+
+def measure(func, min_time, max_runs, setup=None) -> list:
+    # run func until min_time secs are spent or max_runs is reached, setup is not timed
+    timings = []
+    spent = 0.0
+    while len(timings) < max_runs and (spent < min_time or len(timings) < 3):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        timings.append(elapsed)
+        spent += elapsed
+    return timings
+
+def percentile(values, percent) -> float:
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+def summarize(name, params, timings) -> dict:
+    timings = sorted(timings)
+    return {
+        "name" : name,
+        "params" : params,
+        "runs" : len(timings),
+        "mean_us" : round(sum(timings) / len(timings) * 1e6, 3),
+        "p50_us" : round(percentile(timings, 50) * 1e6, 3),
+        "p95_us" : round(percentile(timings, 95) * 1e6, 3),
+        "min_us" : round(timings[0] * 1e6, 3)
+    }
+
+def command_update(text, user_id=owner_id) -> FakeUpdate:
+    return FakeUpdate(message=FakeMessage(text, user_id))
+
+def bench_users(path, users, min_time, max_runs) -> list:
+    results = []
+    setup_bot(path, users, 0)
+    context = FakeContext()
+    config_size = os.path.getsize(path)
+    params = {"users" : users}
+
+    parser_update = command_update('/timer 5m')
+    results.append(summarize('command_parser', params, measure(lambda: smarthomebot.command_parser(parser_update, context), min_time, max_runs)))
+    help_update = command_update('/help')
+    results.append(summarize('check_command', dict(params, command='/help'), measure(lambda: smarthomebot.check_command(help_update, context), min_time, max_runs)))
+    admin_update = command_update('/adduser 42')
+    results.append(summarize('check_command', dict(params, command='/adduser'), measure(lambda: smarthomebot.check_command(admin_update, context), min_time, max_runs)))
+
+    list_update = command_update('/listusers')
+    list_users = lambda: smarthomebot.users_list(list_update, '/listusers', fake_chat_id)
+    list_users()
+    results.append(summarize('users_list', dict(params, cache='warm'), measure(list_users, min_time, max_runs)))
+    results.append(summarize('users_list', dict(params, cache='profiles'), measure(list_users, min_time, max(3, max_runs // 10), setup=smarthomebot.render_cache.clear)))
+    def clear_caches() -> None:
+        smarthomebot.render_cache.clear()
+        smarthomebot.member_cache.invalidate(fake_chat_id)
+    results.append(summarize('users_list', dict(params, cache='cold'), measure(list_users, min_time, max(3, max_runs // 100), setup=clear_caches)))
+
+    message = FakeMessage('Are you sure?', owner_id, 1)
+    query_update = FakeUpdate(callback_query=FakeQuery('n', owner_id, message))
+    add_confirmation = lambda: smarthomebot.pending_confirmations.add((message.chat_id, message.message_id), owner_id, '/adduser', '42')
+    results.append(summarize('keyboard_query', params, measure(lambda: smarthomebot.keyboard_query(query_update, context), min_time, max_runs, setup=add_confirmation)))
+
+    config_params = dict(params, config_bytes=config_size)
+    results.append(summarize('store_config', config_params, measure(smarthomebot.store_config, min_time, max(3, max_runs // 10))))
+    results.append(summarize('read_config', config_params, measure(smarthomebot.read_config, min_time, max(3, max_runs // 10))))
+    return results
+
+def bench_timers(path, timers, min_time, max_runs) -> list:
+    results = []
+    setup_bot(path, 10, timers)
+    context = FakeContext()
+    params = {"timers" : timers, "config_bytes" : os.path.getsize(path)}
+
+    list_update = command_update('/timer')
+    results.append(summarize('timer_command', dict(params, action='list'), measure(lambda: smarthomebot.timer_command(list_update, context, '/timer', None, fake_chat_id), min_time, max_runs)))
+    start_update = command_update('/timer 5m')
+    def start_timer() -> None:
+        smarthomebot.timer_command(start_update, context, '/timer', '5m', fake_chat_id)
+    def drop_last_timer() -> None:
+        smarthomebot.timer_scheduler.cancel(smarthomebot.timer_scheduler.next_id - 1)
+    timings = []
+    for n in range(max(3, max_runs // 10)):
+        timings += measure(start_timer, 0, 1)
+        drop_last_timer()
+        if sum(timings) > min_time and len(timings) >= 3:
+            break
+    results.append(summarize('timer_command', dict(params, action='start'), timings))
+    return results
+
+def bench_startup(runs, top=15):
+    # import the bot module in fresh interpreters with -X importtime, returns timings and the slowest imports
+    bot_directory = os.path.dirname(os.path.abspath(smarthomebot.__file__))
+    timings = []
+    imports = {}
+    for n in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import smarthomebot'], cwd=bot_directory, capture_output=True, text=True)
+        timings.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr.strip().splitlines()[-1])
+        # lines look like "import time:       412 |       1734 |   telegram.ext"
+        for line in process.stderr.splitlines():
+            fields = line.split('|')
+            if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            imports.setdefault(fields[2].strip(), []).append(int(fields[1]))
+    profile = [{"module" : module, "cumulative_us" : sorted(times)[len(times) // 2]} for module, times in imports.items()]
+    profile.sort(key=lambda entry: -entry["cumulative_us"])
+    return [summarize('startup_import', {"runs" : runs}, timings)], profile[:top]
+
+def compare(results, baseline_path, tolerance) -> int:
+    # print p50 ratio against a previous run, return the number of regressions over tolerance
+    file = open(baseline_path, 'r')
+    baseline = json.loads(file.read())
+    file.close()
+    baseline_dict = {(entry["name"], json.dumps(entry["params"], sort_keys=True)) : entry for entry in baseline.get("results", [])}
+    regressions = 0
+    for entry in results:
+        previous = baseline_dict.get((entry["name"], json.dumps(entry["params"], sort_keys=True)))
+        if previous is None or previous["p50_us"] == 0:
+            continue
+        ratio = entry["p50_us"] / previous["p50_us"]
+        flag = ''
+        if ratio > tolerance:
+            regressions += 1
+            flag = ' REGRESSION'
+        print(f'{entry["name"]} {entry["params"]}: {previous["p50_us"]:.1f}us -> {entry["p50_us"]:.1f}us ({ratio:.2f}x){flag}')
+    return regressions
+
+def installed_version() -> str:
+    # version of the bot instance being measured, read from its own config.json
+    try:
+        file = open(smarthomebot.config_file, 'r')
+        json_data = file.read()
+        file.close()
+        return json.loads(json_data).get("BOT_DATA", {}).get("bot_version", '')
+    except (OSError, ValueError):
+        return ''
+
+def int_list(value) -> list:
+    return [int(item) for item in value.split(',') if item.strip()]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark SmartHomeBot command path offline.')
+    parser.add_argument('--users', type=int_list, default=[10, 100, 1000, 10000, 100000], help='comma separated user list sizes')
+    parser.add_argument('--timers', type=int_list, default=[0, 100, 1000, 10000], help='comma separated timer counts')
+    parser.add_argument('--min-time', type=float, default=0.5, help='secs to spend on each benchmark')
+    parser.add_argument('--startup', type=int, default=0, help='times to import the bot in a fresh interpreter, with an import time profile')
+    parser.add_argument('--max-runs', type=int, default=10000, help='max runs of each benchmark')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', default='', help='previous output file to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='p50 ratio reported as a regression')
+    args = parser.parse_args()
+
+    # keep handler logging out of timings
+    logging.disable(logging.WARNING)
+    bot_version = installed_version()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'config.json')
+        for users in args.users:
+            print(f'Benchmarking {users} users...')
+            results += bench_users(path, users, args.min_time, args.max_runs)
+        for timers in args.timers:
+            print(f'Benchmarking {timers} timers...')
+            results += bench_timers(path, timers, args.min_time, args.max_runs)
+    import_profile = []
+    if args.startup > 0:
+        print(f'Benchmarking startup {args.startup} times...')
+        startup_results, import_profile = bench_startup(args.startup)
+        results += startup_results
+
+    report = {
+        "bot_version" : bot_version,
+        "created" : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "machine" : platform.machine(),
+        "results" : results,
+        "import_profile" : import_profile
+    }
+    file = open(args.output, 'w')
+    file.write(json.dumps(report, indent=2))
+    file.close()
+    for entry in results:
+        print(f'{entry["name"]} {entry["params"]}: p50 {entry["p50_us"]:.1f}us, p95 {entry["p95_us"]:.1f}us, runs {entry["runs"]}')
+    for entry in import_profile:
+        print(f'import {entry["module"]}: {entry["cumulative_us"] / 1000:.1f}ms')
+    print(f'Results written to {args.output}')
+    if args.compare and compare(results, args.compare, args.tolerance) > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
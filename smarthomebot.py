@@ -7,19 +7,24 @@
 # Usage:
 # Use /help to list available commands.
 
-import logging, os, time, json, psutil, re, requests, threading, math
+import time
+# taken before any other import, so startup time includes loading telegram
+startup_started = time.perf_counter()
+import logging, os, sys, io, csv, json, re, threading, heapq, hmac, bisect, importlib, itertools, select, struct
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from telegram import Update, User, InlineKeyboardButton, InlineKeyboardMarkup, Bot
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, CallbackQueryHandler
-from gpiozero import CPUTemperature
-from datetime import datetime
+from telegram.error import RetryAfter, NetworkError, BadRequest, TimedOut
+from telegram.ext import Updater, MessageHandler, MessageFilter, Filters, CallbackContext, CallbackQueryHandler, DispatcherHandlerStop
+from datetime import datetime, timedelta
+startup_imported = time.perf_counter()
 
 # define some bot variables
-commands = ['/start', '/help', '/listusers', '/adminusers', '/chatmembers', '/join', '/time', '/timer', '/alarm', '/admincommands', '/requests', '/dismiss', '/adduser', '/removeuser', '/banuser', '/unban', '/makeadmin', '/revokeadmin', '/banlist', '/version', '/system', '/reboot']
-super_commands = ['/admincommands', '/requests', '/dismiss', '/adduser', '/removeuser', '/banuser', '/unban', '/makeadmin', '/revokeadmin', '/banlist', '/version', '/system', '/reboot']
 keyboard_dict = { 
     "yes_no" : {"y" : "yes", "n" : "no"}
 }
 callback_dict = {
+    "/join" : "Your request has been sent to admins.",
     "/dismiss" : "User request dismissed.",
     "/adduser" : "User added to allowed users list.",
     "/removeuser" : "User removed from allowed users list.",
@@ -28,76 +33,51 @@ callback_dict = {
     "/makeadmin" : "User added to admins list.",
     "/revokeadmin" : "User removed from admins list."
 }
+# confirmation and answer of user management commands given several user ids
+bulk_dict = {
+    "/dismiss" : ("Dismiss requests of {count} users?", "{count} requests dismissed."),
+    "/adduser" : ("Add {count} users to allowed users list?", "{count} users added to allowed users list."),
+    "/removeuser" : ("Remove {count} users from allowed users list?", "{count} users removed from allowed users list."),
+    "/banuser" : ("Add {count} users to banned users list?", "{count} users added to banned users list."),
+    "/unban" : ("Remove {count} users from banned users list?", "{count} users removed from banned users list."),
+    "/makeadmin" : ("Add {count} users to admins list?", "{count} users added to admins list."),
+    "/revokeadmin" : ("Remove {count} users from admins list?", "{count} users removed from admins list.")
+}
+bulk_max_users = 1000
+upload_max_size = 256 * 1024
 listusers_dict = {
     '/listusers' : '*List of users allowed to use this bot:*\n',
     '/adminusers' : '*List of admins:*\n',
     '/chatmembers' : '*List of chat members:*\n',
     '/banlist' : '*List of banned users:*\n'
 }
+# commands whose argument is the rest of the message, e.g. /broadcast some text or /adduser id id id
+text_arg_commands = ['/broadcast', '/alarm', '/dismiss', '/adduser', '/removeuser', '/banuser', '/unban', '/makeadmin', '/revokeadmin']
+# sub-commands that take an extra argument, e.g. /timer cancel id
+multi_arg_dict = {
+    '/timer' : ['cancel'],
+    '/system' : ['history'],
+    '/requests' : ['approve', 'dismiss']
+}
+timer_units_dict = {
+    's' : 'seconds',
+    'm' : 'minutes',
+    'h' : 'hours'
+}
 timers_dict = {
     '/timer' : {
+        'timer_name' : 'Timer',
         'timer_start' : 'timer started.',
         'timer_stop' : 'timer has ended.'
     },
     '/alarm' : {
+        'timer_name' : 'Alarm',
         'timer_start' : 'Alarm configured at',
         'timer_stop' : 'alarm has ended.'
     }
 }
-
-# multiline markup text used for /help command.
-help_str = """
-This is a simple Telegram Bot used to automate notifications for a Smart Home\.
-
-*Available commands*
-``\/start`` \- Does nothing, bot starts automatically\.
-``\/help`` \- Shows a list of all available commands\.
-``\/listusers`` \- List all users allowed to use this bot\.
-``\/adminusers`` \- List all users with admin capabilities\.
-``\/chatmembers`` \- List members of the chat, including allowed users, admins and bot\.
-``\/join`` \- Lets users ask an admin to approve them into allowed users list\.
-``\/time`` \- Display local time\.
-``\/timer`` \- Sets a timer and notifies when it\'s over\.
-``\/alarm`` \- Sets an alarm and notifies when it\'s over\.
-
-For admin restricted commands use ``\/admincommands``\.
-"""
-
-help_admin_str = """
-*Admin restricted commands*
-``\/requests`` \- Let admins check pending requests to join allowed users list, and approve or dismiss them\.
-``\/dismiss`` \- Dismiss a request for joining allowed users list\. Remember to add user\_id argument\.
-``\/adduser`` \- Add a user to allowed users list with user\_id argument\.
-``\/removeuser`` \- Remove a user from allowed users list with user\_id argument\. Bot owner can\'t be banned\.
-``\/banuser`` \- Add a user to banned users list so he can\'t request joining allowed users list\.  Remember to add user\_id argument\.
-``\/unban`` \- Remove a user from banned users list\.  Remember to add user\_id argument\.
-``\/makeadmin`` \- Add a user to admins list with user\_id argument\.
-``\/revokeadmin`` \- Remove a user from admins list with user\_id argument\. Bot owner can\'t be removed\.
-``\/banlist`` \- List all users banned from using the bot\. This users can\'t use join command\.
-``\/version`` \- Shows version of the installed bot instance\.
-``\/system`` \- Shows CPU temp\*, CPU and RAM load\.
-``\/reboot`` \- Reboots system\. Default delay time is 5 secs\. You can configure delay time as an argument\.
-
-\* Available only in Linux
-"""
-
-help_timer_str = """
-*Timer help*
-``\/timer`` \- Checks if there are any configured timers\.
-``\/timer hh:mm`` \- Sets a timer for hh hours and mm minutes\. hh must be above 0, and mm must be between 0 and 59\.
-``\/timer xxxs`` \- Sets a timer for xxx seconds\. Value can be greater than 59 seconds and you must use integers\.
-``\/timer xxxm`` \- Sets a timer for xxx minutes\. Value can be greater than 59 minutes and you must use integers\.
-``\/timer xxxh`` \- Sets a timer for xxx hours\. Value can be greater than 23 hours and you must use integers\.
-"""
-
-help_alarm_str = """
-*Alarm help*
-``\/alarm`` \- Checks if there are any configured timers\.
-``\/alarm hh:mm`` \- Sets a timer for hh hour and mm minutes in 24 hour format\. hh must be between 0 and 23, and mm must be between 0 and 59\.
-"""
-# end of multiline text
-
-parsed_command = parsed_command_arg = ''
+# characters that must be escaped in MarkdownV2 text
+markdown_escape_table = str.maketrans({char : '\\' + char for char in '\\_*[]()~`>#+-=|{}.!'})
 
 # enable logging
 logging.basicConfig(
@@ -105,121 +85,2175 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# handler stats
+# every update handler, command, Bot API call and config write is timed into a fixed bucket latency
+# histogram keyed by (kind, name), plus call and error counts. Recording is a bisect and a few adds
+# under a lock, so it's always on. /stats shows a summary and the same data is exported as Prometheus text.
+stats_kinds_dict = {
+    'handler' : 'Update handlers',
+    'command' : 'Commands',
+    'confirm' : 'Confirmations',
+    'api' : 'Bot API calls',
+    'config' : 'Config writes',
+    'startup' : 'Startup',
+    'pool' : 'Worker pool queue wait'
+}
+stats_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class HandlerStats:
+    def __init__(self, buckets=stats_buckets):
+        self.buckets = buckets
+        self.series = {}
+        self.collectors = []
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def observe(self, kind, name, seconds, error=False) -> None:
+        with self.lock:
+            series = self.series.get((kind, name))
+            if series is None:
+                series = {"count" : 0, "errors" : 0, "sum" : 0.0, "max" : 0.0, "buckets" : [0] * (len(self.buckets) + 1)}
+                self.series[(kind, name)] = series
+            series["count"] += 1
+            series["sum"] += seconds
+            series["max"] = max(series["max"], seconds)
+            series["buckets"][bisect.bisect_left(self.buckets, seconds)] += 1
+            if error:
+                series["errors"] += 1
+
+    def timed(self, kind, name, func, *args, **kwargs):
+        # call func and record its time, exceptions are counted as errors and raised again
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.observe(kind, name, time.perf_counter() - start, True)
+            raise
+        self.observe(kind, name, time.perf_counter() - start)
+        return result
+
+    def quantile(self, series, q) -> float:
+        # upper bound of the bucket holding the q quantile, max if it falls over the last bucket
+        rank = q * series["count"]
+        total = 0
+        for bound, count in zip(self.buckets, series["buckets"]):
+            total += count
+            if total >= rank:
+                return min(bound, series["max"])
+        return series["max"]
+
+    def snapshot(self) -> list:
+        with self.lock:
+            series_list = [dict(series, kind=kind, name=name, buckets=list(series["buckets"])) for (kind, name), series in self.series.items()]
+        return sorted(series_list, key=lambda series: (series["kind"], -series["sum"]))
+
+    def prometheus(self) -> str:
+        def label(value) -> str:
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        lines = [
+            '# HELP smarthomebot_uptime_seconds Time since the bot started.',
+            '# TYPE smarthomebot_uptime_seconds gauge',
+            f'smarthomebot_uptime_seconds {time.time() - self.started:.3f}',
+            '# HELP smarthomebot_handler_seconds Time spent in update handlers, commands, Bot API calls and config writes.',
+            '# TYPE smarthomebot_handler_seconds histogram'
+        ]
+        snapshot = self.snapshot()
+        for series in snapshot:
+            labels = f'kind="{label(series["kind"])}",name="{label(series["name"])}"'
+            total = 0
+            for bound, count in zip(self.buckets, series["buckets"]):
+                total += count
+                lines.append(f'smarthomebot_handler_seconds_bucket{{{labels},le="{bound}"}} {total}')
+            lines.append(f'smarthomebot_handler_seconds_bucket{{{labels},le="+Inf"}} {series["count"]}')
+            lines.append(f'smarthomebot_handler_seconds_sum{{{labels}}} {series["sum"]:.6f}')
+            lines.append(f'smarthomebot_handler_seconds_count{{{labels}}} {series["count"]}')
+        lines.append('# HELP smarthomebot_handler_errors_total Calls that raised an exception.')
+        lines.append('# TYPE smarthomebot_handler_errors_total counter')
+        for series in snapshot:
+            lines.append(f'smarthomebot_handler_errors_total{{kind="{label(series["kind"])}",name="{label(series["name"])}"}} {series["errors"]}')
+        # other components add their own metric lines
+        for collector in self.collectors:
+            lines.extend(collector())
+        return '\n'.join(lines) + '\n'
+
+def stats_handler(callback):
+    # time a dispatcher handler under its own name
+    def stats_callback(update, context) -> None:
+        stats.timed('handler', callback.__name__, callback, update, context)
+    stats_callback.__name__ = callback.__name__
+    return stats_callback
+
+class StatsExporter:
+    # writes Prometheus text to a file every interval secs, e.g. for node_exporter textfile collector
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='stats-exporter', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            self.export()
+        self.export()
+
+    def export(self) -> None:
+        try:
+            write_atomic(self.path, stats.prometheus())
+        except OSError:
+            logger.exception('Could not write stats to %s', self.path)
+
+class StatsHandler:
+    def do_GET(self) -> None:
+        if self.path != self.server.stats_path:
+            self.send_error(404)
+            return
+        response = stats.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args) -> None:
+        logger.debug('Stats %s - %s', self.address_string(), format % args)
+
+class StatsServer:
+    def __init__(self, listen='127.0.0.1', port=9464, path='/metrics'):
+        self.httpd = http_server(listen, port, StatsHandler)
+        self.httpd.stats_path = path
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='stats-server', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+stats = HandlerStats()
+stats_exporter = None
+stats_server = None
+
+# lazy imports
+# psutil, gpiozero and requests are only needed by the system sampler and the release checker, which
+# start after the bot is already receiving updates. They are imported on first use, and the time it
+# took is logged and kept in stats, so the bot doesn't wait on gpiozero pin factory probing at boot.
+# The same goes for sqlite3 and http.server, only used by features that are off by default.
+def lazy_import(module_name):
+    module = sys.modules.get(module_name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        import_time = time.perf_counter() - start
+        stats.observe('startup', f'import {module_name}', import_time)
+        logger.info('Imported %s in %.3f secs', module_name, import_time)
+    return module
+
+def http_server(listen, port, handler):
+    # handlers only define the methods they serve, the base class comes with http.server
+    server = lazy_import('http.server')
+    httpd = server.ThreadingHTTPServer((listen, port), type(handler.__name__, (handler, server.BaseHTTPRequestHandler), {}))
+    httpd.daemon_threads = True
+    return httpd
+
+# persistence
+# in-memory config is authoritative, changes are coalesced over write_delay secs and written to disk
+# by a background thread, using a temp file + fsync + rename so config.json is never left truncated.
+config_file = 'config.json'
+config_lock = threading.RLock()
+
+class ConfigWriter:
+    def __init__(self, path, snapshot, write_delay=1.0):
+        self.path = path
+        self.snapshot = snapshot
+        self.write_delay = write_delay
+        self.dirty = False
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='config-writer', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def mark_dirty(self) -> None:
+        # only the first change of a window wakes the writer, later ones wait for the same write
+        with self.condition:
+            if not self.dirty:
+                self.dirty = True
+                self.condition.notify()
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.dirty and not self.stopping:
+                    self.condition.wait()
+                # let further changes pile up before writing, until the deadline or stop
+                deadline = time.monotonic() + self.write_delay
+                while not self.stopping and time.monotonic() < deadline:
+                    self.condition.wait(deadline - time.monotonic())
+                if self.stopping:
+                    break
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        with self.write_lock:
+            with self.condition:
+                if not self.dirty:
+                    return
+                self.dirty = False
+            try:
+                stats.timed('config', 'write', write_config, self.path, self.snapshot)
+            except OSError:
+                logger.exception('Could not write %s', self.path)
+                self.mark_dirty()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+        else:
+            self.flush()
+
+def write_config(path, snapshot) -> None:
+    with config_lock:
+        json_data = json.dumps(snapshot(), indent=2)
+    # tell the watcher first, it ignores both this write and the previous one, so a check landing
+    # before the rename that only now sees the previous write doesn't take it for a hand edit
+    if config_watcher is not None:
+        config_watcher.written(json_data)
+    write_atomic(path, json_data)
+
+def write_atomic(path, data) -> None:
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = path + '.tmp'
+    # keep mode and owner of the file being replaced, config.json holds the bot token
+    try:
+        file_stat = os.stat(path)
+    except FileNotFoundError:
+        file_stat = None
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666 if file_stat is None else file_stat.st_mode & 0o7777)
+    with open(fd, 'w') as file:
+        if file_stat is not None and hasattr(os, 'fchown'):
+            os.fchmod(fd, file_stat.st_mode & 0o7777)
+            try:
+                os.fchown(fd, file_stat.st_uid, file_stat.st_gid)
+            except OSError:
+                pass
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    # make the rename itself durable
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+config_writer = None
+
+# config watcher
+# hand edits of config.json are applied without a restart. The watcher waits for inotify events on the
+# config directory, or checks the file mtime every interval secs where inotify is not available. The
+# file is only parsed when its content differs from what the bot itself wrote, and only sections
+# that differ from the in-memory config are applied, each one by its handler in config_reload_dict.
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+inotify_event = struct.Struct('iIII')
+
+def inotify_open(path):
+    # non-blocking inotify fd watching the directory of path, None where inotify is not available
+    try:
+        ctypes = lazy_import('ctypes')
+        lazy_import('ctypes.util')
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError, ImportError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(os.path.dirname(os.path.abspath(path))), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+class ConfigWatcher:
+    def __init__(self, path, on_change, interval=5, settle=0.2):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.settle = settle
+        self.fd = None
+        self.file_state = self.stat()
+        # contents of the last write and the one in progress
+        self.written_data = deque(maxlen=2)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='config-watcher', daemon=True)
+
+    def start(self) -> None:
+        self.fd = inotify_open(self.path)
+        if self.fd is None:
+            logger.info('Watching %s every %s secs', self.path, self.interval)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.fd is not None:
+            os.close(self.fd)
+
+    def written(self, json_data) -> None:
+        with self.lock:
+            self.written_data.append(json_data)
+
+    def stat(self):
+        try:
+            file_stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+
+    def run(self) -> None:
+        while not self.stopping.is_set():
+            if self.fd is None:
+                if self.stopping.wait(self.interval):
+                    break
+            else:
+                # short timeout so stop() doesn't wait for the next event
+                readable, _, _ = select.select([self.fd], [], [], 1)
+                if not readable or not self.config_event():
+                    continue
+                # let editors that save in several steps finish
+                if self.stopping.wait(self.settle):
+                    break
+            try:
+                self.check()
+            except Exception:
+                logger.exception('Could not reload %s', self.path)
+
+    def config_event(self) -> bool:
+        # drain pending events, True if any of them is about the config file
+        file_name = os.fsencode(os.path.basename(self.path))
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return False
+        offset = 0
+        found = False
+        while offset + inotify_event.size <= len(data):
+            wd, mask, cookie, name_length = inotify_event.unpack_from(data, offset)
+            offset += inotify_event.size
+            if data[offset:offset + name_length].rstrip(b'\0') == file_name:
+                found = True
+            offset += name_length
+        return found
+
+    def check(self) -> None:
+        file_state = self.stat()
+        if file_state is None or file_state == self.file_state:
+            return
+        self.file_state = file_state
+        with open(self.path, 'r') as file:
+            json_data = file.read()
+        with self.lock:
+            if json_data in self.written_data:
+                return
+        try:
+            new_config = json.loads(json_data)
+        except ValueError as error:
+            logger.error('Ignoring changes to %s, it is not valid JSON: %s', self.path, error)
+            return
+        self.on_change(new_config)
+
+config_watcher = None
+
+# state store
+# users and timers are persisted through a state store. The json backend keeps them in USERS and TIMERS
+# sections of config.json, rewritten whole on every change. The sqlite backend keeps them in indexed
+# tables of a WAL mode database, migrated once from config.json, and every change is a single row
+# update, so config.json only keeps static settings like BOT_DATA.
+class JsonStateStore:
+    file_sections = True
+
+    def load(self, timers_data):
+        return timers_data
+
+    def load_partition(self, chat_id) -> dict:
+        # first allowed chat keeps its users in USERS section, the others in CHATS.chat_users
+        if chat_id == chat_partitions.default_chat:
+            return config.get("USERS", {})
+        return chats_data.get("chat_users", {}).get(str(chat_id), {})
+
+    def unload_partition(self, chat_id, directory) -> None:
+        with config_lock:
+            if chat_id == chat_partitions.default_chat:
+                config.update({"USERS" : directory.to_config()})
+            else:
+                chats_data.setdefault("chat_users", {}).update({str(chat_id) : directory.to_config()})
+
+    def find_chats(self, user_id, role) -> list:
+        return [allowed_chat for allowed_chat in chat_partitions.allowed_chats if user_id in (self.load_partition(allowed_chat).get(role) or [])]
+
+    def save_users(self, user_ids, chat_id) -> None:
+        store_config()
+
+    def save_timer(self, entry) -> None:
+        store_config()
+
+    def delete_timer(self, timer_id) -> None:
+        store_config()
+
+    def save_timers(self, entries) -> None:
+        store_config()
+
+    def config_sections(self, json_config) -> None:
+        json_chats = dict(chats_data)
+        chat_users = dict(json_chats.get("chat_users", {}))
+        for partition_chat, directory in chat_partitions.loaded():
+            if partition_chat == chat_partitions.default_chat:
+                json_config.update({"USERS" : directory.to_config()})
+            else:
+                chat_users.update({str(partition_chat) : directory.to_config()})
+        if chat_users:
+            json_chats.update({"chat_users" : chat_users})
+            json_config.update({"CHATS" : json_chats})
+        if timer_scheduler is not None:
+            json_timers = dict(timers_data)
+            json_timers.update({
+                "timers" : [timer_to_config(entry) for entry in timer_scheduler.list('/timer')],
+                "alarms" : [timer_to_config(entry) for entry in timer_scheduler.list('/alarm')]
+            })
+            json_config.update({"TIMERS" : json_timers})
+
+    def close(self) -> None:
+        pass
+
+class SqliteStateStore:
+    file_sections = False
+    schema_version = 3
+    schema = [
+        # id keeps insertion order of every role list
+        'CREATE TABLE IF NOT EXISTS roles (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, role TEXT NOT NULL, user_id INTEGER NOT NULL, UNIQUE (chat_id, role, user_id))',
+        'CREATE INDEX IF NOT EXISTS roles_user_id ON roles (user_id, role)',
+        'CREATE TABLE IF NOT EXISTS timers (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, label TEXT NOT NULL, due REAL NOT NULL, owner INTEGER, chat_id INTEGER, message_id INTEGER, partition_id INTEGER, schedule TEXT)',
+        'CREATE INDEX IF NOT EXISTS timers_due ON timers (due)'
+    ]
+    timer_columns = ("id", "kind", "label", "due", "owner", "chat_id", "message_id", "partition_id", "schedule")
+
+    def __init__(self, path='smarthomebot.db', default_chat=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = lazy_import('sqlite3').connect(path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            # with WAL, NORMAL only syncs at checkpoints and never corrupts the database
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+                version = self.connection.execute('SELECT value FROM meta WHERE key = ?', ('schema_version',)).fetchone()
+                if version is not None and int(version[0]) < 2:
+                    self.upgrade_partitions(default_chat)
+                if version is not None and int(version[0]) < 3:
+                    self.upgrade_schedules()
+                for statement in self.schema:
+                    self.connection.execute(statement)
+
+    def upgrade_partitions(self, default_chat) -> None:
+        # schema 1 had a single chat, its roles and timers belong to the first allowed chat
+        self.connection.execute('ALTER TABLE roles RENAME TO roles_v1')
+        self.connection.execute(self.schema[0])
+        self.connection.execute('INSERT INTO roles (chat_id, role, user_id) SELECT ?, role, user_id FROM roles_v1 ORDER BY id', (default_chat,))
+        self.connection.execute('DROP TABLE roles_v1')
+        self.connection.execute('ALTER TABLE timers ADD COLUMN partition_id INTEGER')
+        self.connection.execute('UPDATE timers SET partition_id = ?', (default_chat,))
+        self.connection.execute('UPDATE meta SET value = ? WHERE key = ?', ('2', 'schema_version'))
+        logger.info('Upgraded %s to schema version 2.', self.path)
+
+    def upgrade_schedules(self) -> None:
+        # schema 2 had one-shot timers only
+        self.connection.execute('ALTER TABLE timers ADD COLUMN schedule TEXT')
+        self.connection.execute('UPDATE meta SET value = ? WHERE key = ?', ('3', 'schema_version'))
+        logger.info('Upgraded %s to schema version 3.', self.path)
+
+    def load(self, timers_data):
+        # migrate USERS, CHATS.chat_users and TIMERS sections of config.json on first run
+        with self.lock:
+            migrated = self.connection.execute('SELECT value FROM meta WHERE key = ?', ('schema_version',)).fetchone()
+        if migrated is None:
+            self.migrate(timers_data)
+        elif any(config.get("USERS", {}).get(role) for role in user_roles) or chats_data.get("chat_users"):
+            logger.warning('Users in %s are ignored, they are stored in %s.', config_file, self.path)
+        timers = {key : value for key, value in timers_data.items() if key not in ("timers", "alarms")}
+        timers.update({"timers" : [], "alarms" : []})
+        with self.lock:
+            for row in self.connection.execute(f'SELECT {", ".join(self.timer_columns)} FROM timers ORDER BY due, id'):
+                entry = dict(zip(self.timer_columns, row))
+                entry["partition"] = entry.pop("partition_id")
+                timers["timers" if entry.pop("kind") == '/timer' else "alarms"].append(entry)
+        return timers
+
+    def migrate(self, timers_data) -> None:
+        partitions = {chat_partitions.default_chat : config.get("USERS", {})}
+        for allowed_chat in chat_partitions.allowed_chats:
+            if str(allowed_chat) in chats_data.get("chat_users", {}):
+                partitions[allowed_chat] = chats_data.get("chat_users").get(str(allowed_chat))
+        role_rows = [(partition_chat, role, user_id) for partition_chat, users_data in partitions.items() for role in user_roles for user_id in users_data.get(role) or []]
+        timer_rows = []
+        for kind, section in (('/timer', "timers"), ('/alarm', "alarms")):
+            for stored in timers_data.get(section, []):
+                if isinstance(stored, dict):
+                    timer_rows.append(self.timer_row(dict(stored, kind=kind)))
+        # unlike other writes a failure is raised, config.json sections are only dropped once committed
+        try:
+            stats.timed('config', 'migrate', self.transaction, [
+                ('INSERT OR IGNORE INTO roles (chat_id, role, user_id) VALUES (?, ?, ?)', role_rows),
+                ('INSERT OR REPLACE INTO timers (id, kind, label, due, owner, chat_id, message_id, partition_id, schedule) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', timer_rows),
+                ('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [('schema_version', str(self.schema_version)), ('migrated_at', str(time.time()))])
+            ])
+        except lazy_import('sqlite3').Error:
+            logger.error('Could not migrate users and timers from %s to %s, %s is left as it is.', config_file, self.path, config_file)
+            raise
+        logger.info('Migrated %s user roles of %s chats and %s timers from %s to %s.', len(role_rows), len(partitions), len(timer_rows), config_file, self.path)
+
+    def load_partition(self, chat_id) -> dict:
+        users = {role : [] for role in user_roles}
+        with self.lock:
+            for role, user_id in self.connection.execute('SELECT role, user_id FROM roles WHERE chat_id = ? ORDER BY id', (chat_id,)):
+                if role in users:
+                    users[role].append(user_id)
+        return users
+
+    def unload_partition(self, chat_id, directory) -> None:
+        # every change is already stored
+        pass
+
+    def find_chats(self, user_id, role) -> list:
+        with self.lock:
+            return [row[0] for row in self.connection.execute('SELECT chat_id FROM roles WHERE user_id = ? AND role = ?', (user_id, role))]
+
+    def timer_row(self, entry) -> tuple:
+        return (entry["id"], entry["kind"], entry["label"], entry["due"], entry["owner"], entry["chat_id"], entry["message_id"], entry.get("partition", chat_partitions.default_chat), entry.get("schedule"))
+
+    def save_users(self, user_ids, chat_id) -> None:
+        # rows of other users are never touched, role invariants only involve the same user. A batch
+        # of users is a single transaction
+        directory = chat_directory(chat_id)
+        statements = []
+        role_rows = []
+        for user_id in user_ids:
+            roles = directory.stored_roles(user_id)
+            statements.append((f'DELETE FROM roles WHERE chat_id = ? AND user_id = ? AND role NOT IN ({", ".join("?" * len(roles))})', (chat_id, user_id, *roles)))
+            role_rows += [(chat_id, role, user_id) for role in roles]
+        statements.append(('INSERT OR IGNORE INTO roles (chat_id, role, user_id) VALUES (?, ?, ?)', role_rows))
+        self.write('sqlite user', statements)
+
+    def save_timer(self, entry) -> None:
+        self.write('sqlite timer', [('INSERT OR REPLACE INTO timers (id, kind, label, due, owner, chat_id, message_id, partition_id, schedule) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', self.timer_row(entry))])
+
+    def delete_timer(self, timer_id) -> None:
+        self.write('sqlite timer', [('DELETE FROM timers WHERE id = ?', (timer_id,))])
+
+    def save_timers(self, entries) -> None:
+        self.write('sqlite timers', [
+            ('DELETE FROM timers', ()),
+            ('INSERT INTO timers (id, kind, label, due, owner, chat_id, message_id, partition_id, schedule) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [self.timer_row(entry) for entry in entries])
+        ])
+
+    def write(self, name, statements) -> None:
+        # statements run as one transaction, a list of params means executemany
+        try:
+            stats.timed('config', name, self.transaction, statements)
+        except lazy_import('sqlite3').Error:
+            logger.exception('Could not write %s to %s', name, self.path)
+
+    def transaction(self, statements) -> None:
+        with self.lock:
+            with self.connection:
+                for statement, params in statements:
+                    if isinstance(params, list):
+                        self.connection.executemany(statement, params)
+                    else:
+                        self.connection.execute(statement, params)
+
+    def config_sections(self, json_config) -> None:
+        # state lives in the database, only static timer settings stay in config.json
+        json_config.pop("USERS", None)
+        json_config.update({"CHATS" : {key : value for key, value in chats_data.items() if key != "chat_users"}})
+        json_config.update({"TIMERS" : {key : value for key, value in timers_data.items() if key not in ("timers", "alarms")}})
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+def open_state_store():
+    if storage_data.get("backend", "json") == "sqlite":
+        return SqliteStateStore(storage_data.get("path", 'smarthomebot.db'), chat_partitions.default_chat)
+    return JsonStateStore()
+
+state_store = JsonStateStore()
+
+# user directory
+# keeps every role of USERS section as an insertion ordered set (dict keys) so checks are O(1) and
+# lists keep their order when serialized back to config.json. Role invariants are enforced here:
+# owner implies admin, admin implies allowed, banned implies not allowed nor pending request. Bot
+# owners are kept by the first allowed chat only, other chats see them through its owner list and
+# never store them with their own roles.
+# versions come from a single counter, so a reloaded directory never reuses the version of an old one
+state_versions = itertools.count(1)
+user_roles = ['allowed_users', 'admin_users', 'bot_owner', 'chat_members', 'user_requests', 'user_rejects', 'banned_users']
+# roles bot owners have in every chat, and roles they never have
+owner_roles = ('allowed_users', 'admin_users', 'bot_owner')
+not_owner_roles = ('user_requests', 'banned_users')
+
+class UserDirectory:
+    def __init__(self, owners=None):
+        self.lock = threading.RLock()
+        self.roles = {role : {} for role in user_roles}
+        # owner list of the first allowed chat, shared with every other chat
+        self.owners = self.roles['bot_owner'] if owners is None else owners
+        # changed on every role change, rendered listings are keyed by it
+        self.version = next(state_versions)
+
+    @classmethod
+    def from_config(cls, users_data, owners=None):
+        directory = cls(owners)
+        for role in user_roles:
+            for user_id in users_data.get(role) or []:
+                directory.roles[role][user_id] = None
+        if owners is not None and directory.roles['bot_owner']:
+            logger.warning('Ignoring bot owners %s stored with a chat, they are set in USERS section.', list(directory.roles['bot_owner']))
+            directory.roles['bot_owner'].clear()
+        directory.normalize()
+        return directory
+
+    def normalize(self) -> None:
+        with self.lock:
+            roles = self.roles
+            for user_id in roles['bot_owner']:
+                if user_id in roles['banned_users']:
+                    logger.warning('Bot owner %s is on banned users list, unbanning.', user_id)
+                    del roles['banned_users'][user_id]
+            for user_id in roles['banned_users']:
+                for role in ('allowed_users', 'admin_users', 'user_requests'):
+                    if user_id in roles[role]:
+                        logger.warning('Banned user %s removed from %s.', user_id, role)
+                        del roles[role][user_id]
+            for user_id in roles['bot_owner']:
+                roles['admin_users'].setdefault(user_id, None)
+            for user_id in roles['admin_users']:
+                roles['allowed_users'].setdefault(user_id, None)
+            for user_id in roles['allowed_users']:
+                roles['user_requests'].pop(user_id, None)
+
+    def has(self, role, user_id) -> bool:
+        if user_id in self.owners:
+            if role in owner_roles:
+                return True
+            if role in not_owner_roles:
+                return False
+        return user_id in self.roles[role]
+
+    def is_allowed(self, user_id) -> bool:
+        return self.has('allowed_users', user_id)
+
+    def is_admin(self, user_id) -> bool:
+        return self.has('admin_users', user_id)
+
+    def is_owner(self, user_id) -> bool:
+        return self.has('bot_owner', user_id)
+
+    def is_banned(self, user_id) -> bool:
+        return self.has('banned_users', user_id)
+
+    def count(self, role) -> int:
+        if self.owners is self.roles['bot_owner']:
+            return len(self.roles[role])
+        return len(self.users(role))
+
+    def users(self, role) -> list:
+        with self.lock:
+            if self.owners is self.roles['bot_owner']:
+                return list(self.roles[role])
+            if role in not_owner_roles:
+                return [user_id for user_id in self.roles[role] if user_id not in self.owners]
+            members = dict(self.roles[role])
+            if role in owner_roles:
+                members.update(dict.fromkeys(list(self.owners)))
+            return list(members)
+
+    def stored_roles(self, user_id) -> list:
+        # roles of the user kept with this chat, without the ones coming from bot owners
+        with self.lock:
+            return [role for role in user_roles if user_id in self.roles[role]]
+
+    def chat_members(self) -> list:
+        # allowed users first, then every other known member of the chat
+        with self.lock:
+            members = dict.fromkeys(self.users('allowed_users'))
+            members.update(self.roles['chat_members'])
+            return list(members)
+
+    def add(self, role, user_id) -> bool:
+        with self.lock:
+            if user_id in self.roles[role]:
+                return False
+            if role == 'banned_users':
+                for other in ('allowed_users', 'admin_users', 'user_requests'):
+                    self.roles[other].pop(user_id, None)
+            elif role in ('allowed_users', 'admin_users', 'bot_owner'):
+                self.roles['banned_users'].pop(user_id, None)
+                self.roles['user_requests'].pop(user_id, None)
+                self.roles['allowed_users'][user_id] = None
+                if role == 'bot_owner':
+                    self.roles['admin_users'][user_id] = None
+            self.roles[role][user_id] = None
+            self.version = next(state_versions)
+            return True
+
+    def remove(self, role, user_id) -> bool:
+        with self.lock:
+            if user_id not in self.roles[role]:
+                return False
+            del self.roles[role][user_id]
+            if role == 'allowed_users':
+                self.roles['admin_users'].pop(user_id, None)
+            self.version = next(state_versions)
+            return True
+
+    def to_config(self) -> dict:
+        with self.lock:
+            return {role : list(self.roles[role]) for role in user_roles}
+
+# chat partitions
+# every allowed chat has its own user directory, loaded from the state store when the chat is first
+# used. At most max_active of them are kept in memory, least recently used ones are dropped, except
+# the first allowed chat, whose USERS section holds bot owners. Group messages are routed by chat id,
+# private messages to the first chat where the sender is allowed, cached per user.
+class ChatPartitions:
+    def __init__(self, allowed_chats, max_active=64, max_homes=4096):
+        self.allowed_chats = allowed_chats
+        self.allowed = set(allowed_chats)
+        self.default_chat = allowed_chats[0]
+        self.max_active = max_active
+        self.max_homes = max_homes
+        self.active = OrderedDict()
+        self.homes = OrderedDict()
+        self.lock = threading.RLock()
+
+    def directory(self, chat_id) -> UserDirectory:
+        with self.lock:
+            directory = self.active.get(chat_id)
+            if directory is not None:
+                self.active.move_to_end(chat_id)
+                return directory
+            owners = None if chat_id == self.default_chat else self.directory(self.default_chat).owners
+            directory = UserDirectory.from_config(state_store.load_partition(chat_id), owners)
+            self.active[chat_id] = directory
+            self.evict()
+            return directory
+
+    def evict(self) -> None:
+        while len(self.active) > self.max_active:
+            evicted_chat = next(iter(self.active))
+            if evicted_chat == self.default_chat:
+                self.active.move_to_end(evicted_chat)
+                evicted_chat = next(iter(self.active))
+            state_store.unload_partition(evicted_chat, self.active.pop(evicted_chat))
+            member_cache.invalidate(evicted_chat)
+
+    def loaded(self) -> list:
+        with self.lock:
+            return list(self.active.items())
+
+    def route(self, message):
+        # partition of the chat the message comes from
+        message_chat_id = message.chat_id
+        if message_chat_id in self.allowed:
+            return message_chat_id
+        if message.from_user is None or message_chat_id != message.from_user.id:
+            return self.default_chat
+        with self.lock:
+            home = self.homes.get(message_chat_id)
+            if home is not None:
+                self.homes.move_to_end(message_chat_id)
+                return home
+        home = self.find_home(message_chat_id)
+        with self.lock:
+            self.homes[message_chat_id] = home
+            while len(self.homes) > self.max_homes:
+                self.homes.popitem(last=False)
+        return home
+
+    def find_home(self, user_id):
+        stored_chats = None
+        for allowed_chat in self.allowed_chats:
+            with self.lock:
+                directory = self.active.get(allowed_chat)
+            if directory is not None:
+                if directory.is_allowed(user_id):
+                    return allowed_chat
+                continue
+            if stored_chats is None:
+                stored_chats = set(state_store.find_chats(user_id, 'allowed_users'))
+            if allowed_chat in stored_chats:
+                return allowed_chat
+        return self.default_chat
+
+    def forget_home(self, user_id) -> None:
+        # role changes may move a user to another chat
+        with self.lock:
+            self.homes.pop(user_id, None)
+
+class RoleFilter(MessageFilter):
+    # role check in the partition the message is routed to, so it always sees current role lists
+    def __init__(self, role):
+        self.role = role
+        self.name = f'RoleFilter({role})'
+
+    def filter(self, message) -> bool:
+        if message.from_user is None:
+            return False
+        return chat_directory(chat_partitions.route(message)).has(self.role, message.from_user.id)
+
+def chat_directory(chat_id) -> UserDirectory:
+    return chat_partitions.directory(chat_id)
+
+chat_partitions = None
+
+# member profile cache
+# chat member profiles fetched with getChatMember are cached by (chat_id, user_id) with TTL and LRU
+# eviction, so listings only hit Bot API for missing or stale entries, fetched in bounded batches.
+class MemberCache:
+    def __init__(self, ttl=3600, max_size=1024, workers=4):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.workers = workers
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, chat_id, user_id):
+        key = (chat_id, user_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            profile, fetched_at = entry
+            if time.monotonic() - fetched_at > self.ttl:
+                return None
+            self.entries.move_to_end(key)
+            return profile
+
+    def put(self, chat_id, user_id, profile) -> None:
+        key = (chat_id, user_id)
+        with self.lock:
+            self.entries[key] = (profile, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, chat_id, user_id=None) -> None:
+        with self.lock:
+            if user_id is not None:
+                self.entries.pop((chat_id, user_id), None)
+            else:
+                for key in [key for key in self.entries if key[0] == chat_id]:
+                    del self.entries[key]
+
+    def get_many(self, chat_id, user_ids, fetch) -> dict:
+        profiles = {}
+        missing = []
+        for user_id in user_ids:
+            profile = self.get(chat_id, user_id)
+            if profile is None:
+                missing.append(user_id)
+            else:
+                profiles[user_id] = profile
+        if len(missing) == 1:
+            profiles[missing[0]] = self.fetch_one(chat_id, missing[0], fetch)
+        elif len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(missing))) as executor:
+                for user_id, profile in zip(missing, executor.map(lambda user_id: self.fetch_one(chat_id, user_id, fetch), missing)):
+                    profiles[user_id] = profile
+        return profiles
+
+    def fetch_one(self, chat_id, user_id, fetch) -> dict:
+        try:
+            profile = fetch(chat_id, user_id)
+        except Exception:
+            logger.warning('Could not get chat member %s', user_id, exc_info=True)
+            # don't cache failures so next listing retries
+            return {"id" : user_id, "username" : None, "first_name" : 'Unknown', "last_name" : 'user', "missing" : True}
+        self.put(chat_id, user_id, profile)
+        return profile
+
+member_cache = MemberCache()
+
+# render cache
+# listing messages are cached by (command, chat, state version). Versions are bumped only when role
+# sets or pending timers change, so repeated listings of unchanged state skip rebuilding and profile
+# lookups. Entries also expire after ttl secs, like member profiles, so renamed users show up.
+class RenderCache:
+    def __init__(self, ttl=3600, max_size=256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, text) -> None:
+        with self.lock:
+            self.entries[key] = (text, time.monotonic())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+render_cache = RenderCache()
+
+# recurring schedules
+# recurring alarms keep a cron expression, "minute hour day month weekday" with *, lists, ranges and
+# steps, e.g. "30 7 * * 1-5". Only their next fire time is kept, as the due time of the timer, so the
+# scheduler heap holds one entry per alarm and sleeps until the earliest one. Next times are found
+# day by day with date arithmetic, so month ends and leap years are right.
+cron_fields = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7))
+recurring_dict = {
+    'daily' : '*',
+    'weekdays' : '1-5',
+    'weekends' : '0,6'
+}
+
+def parse_cron(expression) -> dict:
+    # set of allowed values of every field, ValueError if the expression is malformed
+    fields = expression.split()
+    if len(fields) != len(cron_fields):
+        raise ValueError(f'{expression} must have {len(cron_fields)} fields')
+    cron = {}
+    for field, (name, low, high) in zip(fields, cron_fields):
+        values = set()
+        for part in field.split(','):
+            part_range, has_step, step = part.partition('/')
+            step = int(step) if has_step else 1
+            if part_range == '*':
+                start, end = low, high
+            elif '-' in part_range:
+                start, end = (int(value) for value in part_range.split('-', 1))
+            else:
+                start = int(part_range)
+                end = high if has_step else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f'{name} {part} is out of range in {expression}')
+            values.update(range(start, end + 1, step))
+        cron[name] = values
+    # 7 is Sunday too
+    if 7 in cron['weekday']:
+        cron['weekday'].discard(7)
+        cron['weekday'].add(0)
+    cron['any_day'] = fields[2] == '*'
+    cron['any_weekday'] = fields[4] == '*'
+    return cron
+
+def cron_day_matches(cron, day) -> bool:
+    # like cron, when both day and weekday are restricted either of them is enough
+    day_matches = day.day in cron['day']
+    weekday_matches = day.isoweekday() % 7 in cron['weekday']
+    if cron['any_day'] or cron['any_weekday']:
+        return day_matches and weekday_matches
+    return day_matches or weekday_matches
+
+def next_fire_time(expression, after):
+    # first epoch timestamp matching expression after the given one, None if there's none in 8 years
+    cron = parse_cron(expression)
+    start = datetime.fromtimestamp(after).replace(second=0, microsecond=0) + timedelta(minutes=1)
+    day_times = sorted((hour, minute) for hour in cron['hour'] for minute in cron['minute'])
+    day = start.date()
+    # Feb 29 may be 8 years away across a century
+    for _ in range(366 * 8):
+        if day.month in cron['month'] and cron_day_matches(cron, day):
+            for hour, minute in day_times:
+                candidate = datetime(day.year, day.month, day.day, hour, minute)
+                if candidate >= start:
+                    return candidate.timestamp()
+        day += timedelta(days=1)
+    return None
+
+def parse_clock(text):
+    # (hour, minute) of a hh:mm time of day, None if it's not one
+    parsed_time = text.split(':')
+    if len(parsed_time) != 2 or not parsed_time[0].isdigit() or not parsed_time[1].isdigit():
+        return None
+    hour, minute = int(parsed_time[0]), int(parsed_time[1])
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+def timer_next_due(entry, after):
+    # next due time of recurring timers, None for one-shot ones
+    if not entry.get("schedule"):
+        return None
+    return next_fire_time(entry["schedule"], after)
+
+# timer scheduler
+# a single worker thread sleeps until the earliest due time of a min-heap of (due, timer_id).
+# Cancelled timers are dropped from the index right away and skipped lazily when popped from heap.
+# Recurring timers are pushed back under the same id with the due time given by next_due.
+class TimerScheduler:
+    def __init__(self, callback, next_due=None):
+        self.callback = callback
+        self.next_due = next_due
+        self.heap = []
+        self.entries = {}
+        self.next_id = 1
+        # changed whenever the set of pending timers changes
+        self.version = next(state_versions)
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='timer-scheduler', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def schedule(self, entry) -> int:
+        # entry is a dict with at least a "due" epoch timestamp
+        with self.condition:
+            timer_id = self.next_id
+            self.next_id += 1
+            entry.update({"id" : timer_id})
+            self.entries[timer_id] = entry
+            self.version = next(state_versions)
+            heapq.heappush(self.heap, (entry["due"], timer_id))
+            # wake worker only if new timer is the earliest one
+            if self.heap[0][1] == timer_id:
+                self.condition.notify()
+            return timer_id
+
+    def cancel(self, timer_id):
+        with self.condition:
+            entry = self.entries.pop(timer_id, None)
+            if entry is not None:
+                self.version = next(state_versions)
+            return entry
+
+    def load(self, entries, replace=False) -> None:
+        # bulk load of restored timers, keeping their ids, with a single heapify
+        with self.condition:
+            if replace:
+                self.entries.clear()
+                self.heap.clear()
+            for entry in entries:
+                self.entries[entry["id"]] = entry
+                self.heap.append((entry["due"], entry["id"]))
+                self.next_id = max(self.next_id, entry["id"] + 1)
+            heapq.heapify(self.heap)
+            self.version = next(state_versions)
+            self.condition.notify()
+
+    def get(self, timer_id):
+        return self.entries.get(timer_id)
+
+    def list(self, kind=None, partition=None) -> list:
+        with self.condition:
+            entries = [entry for entry in self.entries.values() if (kind is None or entry["kind"] == kind) and (partition is None or entry["partition"] == partition)]
+        return sorted(entries, key=lambda entry: (entry["due"], entry["id"]))
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    # drop cancelled timers sitting on top of the heap
+                    while self.heap and self.heap[0][1] not in self.entries:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if self.stopping:
+                    return
+                due, timer_id = heapq.heappop(self.heap)
+                entry = self.entries.pop(timer_id)
+                next_due = self.next_due(entry, max(due, time.time())) if self.next_due is not None else None
+                if next_due is not None:
+                    entry["due"] = next_due
+                    self.entries[timer_id] = entry
+                    heapq.heappush(self.heap, (next_due, timer_id))
+                self.version = next(state_versions)
+            try:
+                self.callback(entry)
+            except Exception:
+                logger.exception('Timer %s callback failed', timer_id)
+
+timer_scheduler = None
+
+# system metrics sampler
+# CPU load, RAM, CPU temperature and disk usage are sampled every sample_interval secs into a fixed
+# size ring buffer, so /system replies from the latest sample instead of blocking on cpu_percent.
+sparkline_chars = '▁▂▃▄▅▆▇█'
+system_metrics = {
+    "cpu_temp" : ('CPU temperature', '°C'),
+    "cpu_load" : ('CPU load', '%'),
+    "ram_load" : ('RAM load', '%'),
+    "disk_usage" : ('Disk usage', '%')
+}
+
+class SystemSampler:
+    def __init__(self, interval=10, size=360, disk_path='/'):
+        self.interval = interval
+        self.disk_path = disk_path
+        self.samples = deque(maxlen=size)
+        self.listeners = []
+        self.cpu_temperature = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='system-sampler', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def run(self) -> None:
+        psutil = lazy_import('psutil')
+        # first call of cpu_percent only sets the reference point for the next one
+        psutil.cpu_percent(None)
+        if psutil.LINUX:
+            try:
+                self.cpu_temperature = lazy_import('gpiozero').CPUTemperature()
+            except Exception:
+                logger.warning('CPU temperature is not available', exc_info=True)
+        delay = min(1, self.interval)
+        while not self.stopping.wait(delay):
+            try:
+                sample = self.sample()
+                self.samples.append(sample)
+                for listener in self.listeners:
+                    listener(sample)
+            except Exception:
+                logger.exception('Could not sample system metrics')
+            delay = self.interval
+
+    def sample(self) -> dict:
+        psutil = lazy_import('psutil')
+        cpu_temp = None
+        if self.cpu_temperature is not None:
+            cpu_temp = self.cpu_temperature.temperature
+        return {
+            "time" : time.time(),
+            "cpu_temp" : cpu_temp,
+            "cpu_load" : psutil.cpu_percent(None),
+            "ram_load" : psutil.virtual_memory().percent,
+            "disk_usage" : psutil.disk_usage(self.disk_path).percent
+        }
+
+    def latest(self):
+        if len(self.samples) == 0:
+            return None
+        return self.samples[-1]
+
+    def history(self, minutes) -> list:
+        since = time.time() - minutes*60
+        return [sample for sample in list(self.samples) if sample["time"] >= since]
+
+def sparkline(values, width=20) -> str:
+    # average values into width buckets, then map each bucket to a block char
+    if len(values) > width:
+        step = len(values) / width
+        values = [sum(values[int(n*step):int((n+1)*step)]) / len(values[int(n*step):int((n+1)*step)]) for n in range(width)]
+    low = min(values)
+    high = max(values)
+    if high == low:
+        return sparkline_chars[0] * len(values)
+    scale = (len(sparkline_chars) - 1) / (high - low)
+    return ''.join(sparkline_chars[round((value - low) * scale)] for value in values)
+
+system_sampler = None
+
+# alert rules
+# rules from RULES section are compiled once into predicates and indexed by metric, so a new sample
+# is only checked against rules that reference its metric. A rule fires after its condition holds
+# for "for" secs, stays active until its "clear" condition (hysteresis) and won't fire again within
+# "cooldown" secs. Conditions join terms with "and", e.g. "door == open and home == 0" or
+# "rate(humidity) > 10" where rate is change per hour.
+rule_ops = {
+    '>' : lambda a, b: a > b,
+    '<' : lambda a, b: a < b,
+    '>=' : lambda a, b: a >= b,
+    '<=' : lambda a, b: a <= b,
+    '==' : lambda a, b: a == b,
+    '!=' : lambda a, b: a != b
+}
+rule_term_regex = re.compile(r'^\s*(?:(rate)\(\s*(\w+)\s*\)|(\w+))\s*(>=|<=|==|!=|>|<)\s*([^<>=!\s].*?)\s*$')
+
+def parse_rule_value(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value.strip('\'"')
+
+def compile_condition(condition) -> list:
+    predicates = []
+    for term in re.split(r'\s+and\s+', condition.strip()):
+        match = rule_term_regex.match(term)
+        if match is None:
+            raise ValueError(f'Malformed rule term "{term}"')
+        kind, rate_metric, metric, op, value = match.groups()
+        predicates.append({"kind" : kind or 'value', "metric" : rate_metric or metric, "op" : rule_ops[op], "value" : parse_rule_value(value)})
+    return predicates
+
+class RuleEngine:
+    def __init__(self, rules=(), rate_window=3600, notify=None):
+        self.rate_window = rate_window
+        self.notify = notify
+        self.rules = []
+        self.index = {}
+        self.latest = {}
+        self.history = {}
+        self.lock = threading.Lock()
+        for rule in rules:
+            try:
+                self.add_rule(rule)
+            except (KeyError, ValueError) as error:
+                logger.error('Skipping rule %s: %s', rule.get("name"), error)
+
+    def add_rule(self, rule) -> None:
+        compiled = {
+            "name" : rule["name"],
+            "condition" : rule["condition"],
+            "predicates" : compile_condition(rule["condition"]),
+            "clear" : compile_condition(rule["clear"]) if rule.get("clear") else None,
+            "for" : rule.get("for", 0),
+            "cooldown" : rule.get("cooldown", 300),
+            "message" : rule.get("message", rule["name"]),
+            "clear_message" : rule.get("clear_message"),
+            "priority" : rule.get("priority", 'alarm'),
+            "active" : False,
+            "notified" : False,
+            "since" : None,
+            "fired_at" : None,
+            "count" : 0
+        }
+        self.rules.append(compiled)
+        rule_number = len(self.rules) - 1
+        for predicate in compiled["predicates"] + (compiled["clear"] or []):
+            rule_numbers = self.index.setdefault(predicate["metric"], [])
+            if rule_number not in rule_numbers:
+                rule_numbers.append(rule_number)
+            if predicate["kind"] == 'rate':
+                self.history.setdefault(predicate["metric"], deque())
+
+    def feed_sample(self, sample) -> None:
+        self.feed({metric : value for metric, value in sample.items() if metric != "time" and value is not None}, sample.get("time"))
+
+    def feed(self, metrics, sample_time=None) -> None:
+        if sample_time is None:
+            sample_time = time.time()
+        notifications = []
+        with self.lock:
+            rule_numbers = set()
+            for metric, value in metrics.items():
+                self.latest[metric] = value
+                history = self.history.get(metric)
+                if history is not None and isinstance(value, (int, float)):
+                    history.append((sample_time, value))
+                    while history and history[0][0] < sample_time - self.rate_window:
+                        history.popleft()
+                rule_numbers.update(self.index.get(metric, []))
+            for rule_number in sorted(rule_numbers):
+                notification = self.evaluate(self.rules[rule_number], sample_time)
+                if notification is not None:
+                    notifications.append(notification)
+        for text, priority in notifications:
+            if self.notify is not None:
+                self.notify(text, priority)
+
+    def rate(self, metric):
+        history = self.history.get(metric)
+        if not history or len(history) < 2 or history[-1][0] == history[0][0]:
+            return None
+        return (history[-1][1] - history[0][1]) / ((history[-1][0] - history[0][0]) / 3600)
+
+    def check(self, predicates) -> bool:
+        for predicate in predicates:
+            if predicate["kind"] == 'rate':
+                value = self.rate(predicate["metric"])
+            else:
+                value = self.latest.get(predicate["metric"])
+            if value is None:
+                return False
+            try:
+                if not predicate["op"](value, predicate["value"]):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def evaluate(self, rule, now):
+        if rule["active"]:
+            cleared = self.check(rule["clear"]) if rule["clear"] is not None else not self.check(rule["predicates"])
+            if cleared:
+                rule["active"] = False
+                rule["since"] = None
+                # only tell it cleared if firing was notified, not muted by cooldown
+                if rule["clear_message"] and rule["notified"]:
+                    return (self.format(rule["clear_message"]), rule["priority"])
+            return None
+        if not self.check(rule["predicates"]):
+            rule["since"] = None
+            return None
+        if rule["since"] is None:
+            rule["since"] = now
+        if now - rule["since"] < rule["for"]:
+            return None
+        rule["active"] = True
+        rule["notified"] = False
+        if rule["fired_at"] is not None and now - rule["fired_at"] < rule["cooldown"]:
+            return None
+        rule["notified"] = True
+        rule["fired_at"] = now
+        rule["count"] += 1
+        return (self.format(rule["message"]), rule["priority"])
+
+    def format(self, message) -> str:
+        values = {metric : round(value, 1) if isinstance(value, float) else value for metric, value in self.latest.items()}
+        try:
+            return message.format_map(values)
+        except (KeyError, ValueError, IndexError):
+            return message
+
+    def status(self) -> list:
+        with self.lock:
+            return [{"name" : rule["name"], "condition" : rule["condition"], "active" : rule["active"], "count" : rule["count"]} for rule in self.rules]
+
+def notify_chats(text, priority='reply') -> None:
+    for notify_chat_id in event_chats():
+        send_message(notify_chat_id, text, priority)
+
+rule_engine = None
+
+# release checker
+# latest GitHub release is refreshed every interval secs in background using a pooled session and
+# ETag/If-None-Match, so unchanged releases cost a 304. /version answers from the cached release.
+github_releases_url = "https://api.github.com/repos/Geek-MD/SmartHomeBot/releases/latest"
+
+def parse_version(version) -> tuple:
+    # "v1.10.2" -> (1, 10, 2), non numeric parts compare as 0
+    parts = []
+    for part in str(version).strip().lstrip('vV').split('-')[0].split('.'):
+        parts.append(int(part) if part.isdigit() else 0)
+    while len(parts) > 1 and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
+
+class ReleaseChecker:
+    def __init__(self, endpoint=github_releases_url, interval=21600, timeout=10, offline=False):
+        self.endpoint = endpoint
+        self.interval = interval
+        self.timeout = timeout
+        self.offline = offline
+        self.session = None
+        self.etag = None
+        self.version = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='release-checker', daemon=True)
+
+    def start(self) -> None:
+        if not self.offline:
+            self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def run(self) -> None:
+        while True:
+            self.refresh()
+            if self.stopping.wait(self.interval):
+                break
+
+    def refresh(self) -> None:
+        requests = lazy_import('requests')
+        with self.lock:
+            if self.session is None:
+                self.session = requests.Session()
+                self.session.headers.update({"Accept" : "application/vnd.github+json"})
+            headers = {}
+            if self.etag is not None:
+                headers.update({"If-None-Match" : self.etag})
+            try:
+                response = self.session.get(self.endpoint, headers=headers, timeout=self.timeout)
+                if response.status_code == 304:
+                    self.checked_at = time.time()
+                elif response.status_code == 200:
+                    self.version = response.json()["name"]
+                    self.etag = response.headers.get("ETag")
+                    self.checked_at = time.time()
+                else:
+                    logger.warning('Release check failed with HTTP status %s', response.status_code)
+            except (requests.RequestException, ValueError, KeyError):
+                logger.warning('Release check failed', exc_info=True)
+
+release_checker = None
+
+# pending confirmations
+# every yes/no keyboard is stored with its requester, command and argument, keyed by the message
+# that holds the keyboard, so callbacks resolve in O(1). Entries expire after ttl secs and the store
+# is bounded to max_size entries, oldest ones are dropped first.
+class ConfirmationStore:
+    def __init__(self, ttl=300, max_size=256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, key, user_id, command, arg, chat_id=None) -> None:
+        with self.lock:
+            self.expire()
+            self.entries[key] = {"user_id" : user_id, "command" : command, "arg" : arg, "chat_id" : chat_id, "created" : time.monotonic()}
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            self.expire()
+            return self.entries.get(key)
+
+    def pop(self, key):
+        with self.lock:
+            self.expire()
+            return self.entries.pop(key, None)
+
+    def expire(self) -> None:
+        # entries are kept in creation order, so expired ones are always at the front
+        deadline = time.monotonic() - self.ttl
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if entry["created"] >= deadline:
+                break
+            del self.entries[key]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+pending_confirmations = ConfirmationStore()
+
+# outbound queue
+# every message goes through a priority queue drained under a global and per-chat token bucket, so
+# bursts stay within Telegram rate limits. RetryAfter pauses the chat for the requested time, network
+# errors are retried with exponential backoff. Bad requests and timeouts fail right away, the latter
+# may have been delivered already and a retry would send the message twice. Each send returns a Future
+# with the sent message. On stop, queued messages get drain_timeout secs to go out, the rest fail.
+# Chat buckets are kept for the max_chats most recently used chats. A full bucket is the same as a
+# new one, so only those are dropped, and a chat that's still paused or rate limited keeps its bucket.
+priority_dict = {
+    'alarm' : 0,
+    'reply' : 1,
+    'listing' : 2,
+    'broadcast' : 3
+}
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def ready_at(self, now) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def pause(self, secs) -> None:
+        self.tokens = min(self.tokens, 1 - secs * self.rate)
+
+class OutboundQueue:
+    def __init__(self, bot, global_rate=30, chat_rate=1, group_rate=20/60, burst=3, max_retries=5, workers=4, max_chats=4096):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.heap = []
+        self.seq = 0
+        self.buckets = OrderedDict()
+        self.max_chats = max_chats
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.in_flight = set()
+        self.sent = self.failed = self.retried = 0
+        self.stopping = False
+        self.drain_deadline = None
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sender')
+        self.thread = threading.Thread(target=self.run, name='outbound-queue', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self, drain_timeout=5) -> None:
+        with self.condition:
+            self.stopping = True
+            self.drain_deadline = time.monotonic() + drain_timeout
+            self.condition.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+        # whatever didn't make it, including retries pushed by the last deliveries
+        with self.condition:
+            items = [entry[2] for entry in self.heap]
+            self.heap.clear()
+        if items:
+            logger.warning('Dropping %s queued messages on stop', len(items))
+        for item in items:
+            self.failed += 1
+            item["future"].set_exception(RuntimeError('Outbound queue stopped'))
+
+    def send(self, method, chat_id, priority='reply', **kwargs) -> Future:
+        future = Future()
+        item = {"method" : method, "chat_id" : chat_id, "kwargs" : kwargs, "future" : future, "priority" : priority_dict.get(priority), "attempt" : 0, "not_before" : 0}
+        self.push(item)
+        return future
+
+    def push(self, item) -> None:
+        with self.condition:
+            self.seq += 1
+            heapq.heappush(self.heap, (item["priority"], self.seq, item))
+            self.condition.notify()
+
+    def pending(self) -> int:
+        return len(self.heap)
+
+    def configure(self, global_rate, chat_rate, group_rate, burst, max_retries, max_chats) -> None:
+        # chats get new buckets on their next message, the number of workers needs a restart
+        with self.condition:
+            self.chat_rate = chat_rate
+            self.group_rate = group_rate
+            self.burst = burst
+            self.max_retries = max_retries
+            self.max_chats = max_chats
+            self.global_bucket.rate = self.global_bucket.capacity = global_rate
+            self.buckets.clear()
+            self.condition.notify()
+
+    def bucket(self, chat_id) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            # negative ids are groups, which Telegram limits to 20 messages per minute
+            bucket = TokenBucket(self.group_rate if int(chat_id) < 0 else self.chat_rate, self.burst)
+            self.buckets[chat_id] = bucket
+            self.trim()
+        else:
+            self.buckets.move_to_end(chat_id)
+        return bucket
+
+    def trim(self) -> None:
+        # drop least recently used buckets while they're full, the rest refill soon enough
+        now = time.monotonic()
+        while len(self.buckets) > self.max_chats:
+            oldest = next(iter(self.buckets.values()))
+            oldest.ready_at(now)
+            if oldest.tokens < oldest.capacity:
+                break
+            self.buckets.popitem(last=False)
+
+    def next_ready(self):
+        # highest priority message whose chat is not busy or rate limited, plus secs to wait if none
+        now = time.monotonic()
+        skipped = []
+        ready_item = None
+        wait = None
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            item = entry[2]
+            chat_id = item["chat_id"]
+            skipped.append(entry)
+            # keep messages of a chat in order, one in flight at a time
+            if chat_id in self.in_flight:
+                continue
+            ready_at = max(item["not_before"], self.bucket(chat_id).ready_at(now))
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+            global_ready_at = self.global_bucket.ready_at(now)
+            if global_ready_at > now:
+                wait = global_ready_at - now if wait is None else min(wait, global_ready_at - now)
+                break
+            skipped.pop()
+            self.bucket(chat_id).consume()
+            self.global_bucket.consume()
+            self.in_flight.add(chat_id)
+            ready_item = item
+            break
+        for entry in skipped:
+            heapq.heappush(self.heap, entry)
+        return ready_item, wait
+
+    def run(self) -> None:
+        while True:
+            with self.condition:
+                if self.stopping:
+                    drain_left = self.drain_deadline - time.monotonic()
+                    if not self.heap or drain_left <= 0:
+                        break
+                item, wait = self.next_ready()
+                if item is None:
+                    if self.stopping:
+                        wait = drain_left if wait is None else min(wait, drain_left)
+                    self.condition.wait(wait)
+                    continue
+            self.executor.submit(self.deliver, item)
+
+    def deliver(self, item) -> None:
+        chat_id = item["chat_id"]
+        retry = False
+        try:
+            result = stats.timed('api', item["method"], getattr(self.bot, item["method"]), chat_id=chat_id, **item["kwargs"])
+            self.sent += 1
+            item["future"].set_result(result)
+        except RetryAfter as error:
+            logger.warning('Rate limited on chat %s, retrying in %s secs', chat_id, error.retry_after)
+            item["not_before"] = time.monotonic() + error.retry_after
+            with self.condition:
+                self.bucket(chat_id).pause(error.retry_after)
+            retry = True
+        except (BadRequest, TimedOut) as error:
+            self.failed += 1
+            item["future"].set_exception(error)
+        except NetworkError as error:
+            item["attempt"] += 1
+            if item["attempt"] > self.max_retries:
+                self.failed += 1
+                item["future"].set_exception(error)
+            else:
+                item["not_before"] = time.monotonic() + min(60, 2 ** item["attempt"])
+                retry = True
+        except Exception as error:
+            self.failed += 1
+            item["future"].set_exception(error)
+        with self.condition:
+            self.in_flight.discard(chat_id)
+            self.condition.notify()
+        if retry:
+            self.retried += 1
+            self.push(item)
+
+outbound_queue = None
+
+def send_message(chat_id, text, priority='reply', **kwargs) -> Future:
+    # send through outbound queue when it's running, otherwise right away
+    if outbound_queue is not None:
+        return outbound_queue.send('send_message', chat_id, priority, text=text, **kwargs)
+    future = Future()
+    future.set_result(stats.timed('api', 'send_message', bot.send_message, chat_id=chat_id, text=text, **kwargs))
+    return future
+
+def reply_text(update: Update, text, priority='reply', **kwargs) -> Future:
+    return send_message(update.message.chat_id, text, priority, **kwargs)
+
+def reply_markdown_v2(update: Update, text, priority='reply', **kwargs) -> Future:
+    return send_message(update.message.chat_id, text, priority, parse_mode='MarkdownV2', **kwargs)
+
+# flood control
+# every message is admitted before any handler parses it. Each sender has a token bucket of rate
+# messages per sec, messages over it are dropped silently, and a sender who gets ban_after messages
+# dropped within ban_window secs is ignored for ban_time secs. Not allowed users are told so once,
+# then kept in a negative cache of (chat, user) for reject_ttl secs, so their messages to that chat
+# are dropped without reply, except for /join. Users are allowed per chat, so other chats are not.
+# All tables are bounded to max_users entries, least recently seen ones are dropped first.
+flood_reasons_dict = {
+    'rate' : 'Over rate limit',
+    'rejected' : 'Not allowed, already told',
+    'banned' : 'Temporarily banned'
+}
+
+class FloodControl:
+    def __init__(self, rate=1, burst=5, reject_ttl=600, ban_after=20, ban_window=60, ban_time=3600, max_users=4096):
+        self.senders = OrderedDict()
+        self.rejected = OrderedDict()
+        self.bans = OrderedDict()
+        self.dropped = dict.fromkeys(flood_reasons_dict, 0)
+        self.banned_total = 0
+        self.lock = threading.Lock()
+        self.configure(rate, burst, reject_ttl, ban_after, ban_window, ban_time, max_users)
+
+    def configure(self, rate, burst, reject_ttl, ban_after, ban_window, ban_time, max_users) -> None:
+        # senders get new buckets, running bans and rejections are kept
+        with self.lock:
+            self.rate = rate
+            self.burst = burst
+            self.reject_ttl = reject_ttl
+            self.ban_after = ban_after
+            self.ban_window = ban_window
+            self.ban_time = ban_time
+            self.max_users = max_users
+            self.senders.clear()
+
+    def admit(self, user_id, text='', chat_id=None) -> str:
+        # None when the message may go on to handlers, otherwise the reason it was dropped
+        now = time.monotonic()
+        with self.lock:
+            banned_until = self.bans.get(user_id)
+            if banned_until is not None:
+                if now < banned_until:
+                    return self.drop('banned')
+                del self.bans[user_id]
+            # users are allowed per chat, so rejections are too
+            rejected = self.rejected.get((chat_id, user_id))
+            if rejected is not None:
+                rejected_until, allow_join = rejected
+                if now >= rejected_until:
+                    del self.rejected[(chat_id, user_id)]
+                elif not (allow_join and text.startswith('/join')):
+                    return self.drop('rejected')
+            sender = self.senders.get(user_id)
+            if sender is None:
+                sender = {"bucket" : TokenBucket(self.rate, self.burst), "since" : now, "drops" : 0}
+                self.senders[user_id] = sender
+                self.trim(self.senders)
+            else:
+                self.senders.move_to_end(user_id)
+            if sender["bucket"].ready_at(now) <= now:
+                sender["bucket"].consume()
+                return None
+            if now - sender["since"] > self.ban_window:
+                sender["since"] = now
+                sender["drops"] = 0
+            sender["drops"] += 1
+            if sender["drops"] >= self.ban_after:
+                self.bans[user_id] = now + self.ban_time
+                self.trim(self.bans)
+                self.banned_total += 1
+                sender["drops"] = 0
+                logger.warning('User %s is flooding, ignoring it for %s secs', user_id, self.ban_time)
+            return self.drop('rate')
+
+    def drop(self, reason) -> str:
+        self.dropped[reason] += 1
+        return reason
+
+    def reject(self, user_id, chat_id, allow_join=True) -> None:
+        # user was just told it's not allowed in chat, drop its messages there for a while
+        with self.lock:
+            self.rejected[(chat_id, user_id)] = (time.monotonic() + self.reject_ttl, allow_join)
+            self.rejected.move_to_end((chat_id, user_id))
+            self.trim(self.rejected)
+
+    def forget(self, user_id=None, chat_id=None) -> None:
+        # role changes make earlier rejections stale, of one user in a chat or all of them
+        with self.lock:
+            if user_id is not None:
+                self.rejected.pop((chat_id, user_id), None)
+            else:
+                self.rejected.clear()
+
+    def trim(self, table) -> None:
+        while len(table) > self.max_users:
+            table.popitem(last=False)
+
+    def banned(self) -> list:
+        # (user_id, secs left) of temporary bans still running
+        now = time.monotonic()
+        with self.lock:
+            return [(user_id, int(banned_until - now)) for user_id, banned_until in self.bans.items() if banned_until > now]
+
+    def prometheus(self) -> list:
+        with self.lock:
+            dropped = dict(self.dropped)
+            banned_total = self.banned_total
+        lines = ['# HELP smarthomebot_dropped_messages_total Incoming messages dropped by flood control.', '# TYPE smarthomebot_dropped_messages_total counter']
+        lines.extend(f'smarthomebot_dropped_messages_total{{reason="{reason}"}} {count}' for reason, count in dropped.items())
+        lines.extend(['# HELP smarthomebot_flood_bans_total Temporary bans for flooding.', '# TYPE smarthomebot_flood_bans_total counter', f'smarthomebot_flood_bans_total {banned_total}'])
+        return lines
+
+flood_control = FloodControl()
+
+def admit_message(update: Update, context: CallbackContext) -> None:
+    # runs before every other handler, dropped messages stop there
+    message = update.message
+    if message is None or message.from_user is None:
+        return
+    if flood_control.admit(message.from_user.id, message.text or '', chat_partitions.route(message)) is not None:
+        raise DispatcherHandlerStop()
+
+# worker pools
+# commands that make many Bot API calls, aggregate system samples or change state run on small named
+# pools instead of dispatcher threads. Every pool has a bounded queue, and when it's full the command
+# gets a busy reply instead of piling up. Queue wait is timed into stats as kind pool, and queue
+# depth, running tasks and busy replies are shown in /stats and exported to Prometheus.
+pool_dict = {
+    'io' : {"workers" : 4, "max_queue" : 16},
+    'sampling' : {"workers" : 1, "max_queue" : 4},
+    'admin' : {"workers" : 1, "max_queue" : 8}
+}
+pool_busy_text = 'The bot is busy right now, try again in a moment.'
+
+class WorkerPool:
+    def __init__(self, name, workers=1, max_queue=8):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queued = self.running = self.rejected = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-pool')
+
+    def submit(self, func, *args, **kwargs):
+        # Future of func, None when every worker is busy and the queue is full
+        with self.lock:
+            if self.queued + self.running >= self.workers + self.max_queue:
+                self.rejected += 1
+                return None
+            self.queued += 1
+        return self.executor.submit(self.run, time.perf_counter(), func, args, kwargs)
+
+    def run(self, submitted, func, args, kwargs):
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        stats.observe('pool', self.name, time.perf_counter() - submitted)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            logger.exception('Task on %s pool failed', self.name)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def state(self) -> dict:
+        with self.lock:
+            return {"workers" : self.workers, "max_queue" : self.max_queue, "queued" : self.queued, "running" : self.running, "rejected" : self.rejected}
+
+    def stop(self) -> None:
+        self.executor.shutdown(wait=True)
+
+worker_pools = {}
+
+def run_on_pool(pool_name, func, *args, **kwargs) -> bool:
+    # run func on its pool, or right away when it has none or pools are not running. False if busy
+    pool = worker_pools.get(pool_name)
+    if pool is None:
+        func(*args, **kwargs)
+        return True
+    return pool.submit(func, *args, **kwargs) is not None
+
+def pool_prometheus() -> list:
+    pool_states = {pool_name : pool.state() for pool_name, pool in worker_pools.items()}
+    lines = []
+    for metric, key, metric_type, metric_help in (('pool_queue_depth', 'queued', 'gauge', 'Tasks waiting for a worker.'), ('pool_running', 'running', 'gauge', 'Tasks running on a worker.'), ('pool_rejected_total', 'rejected', 'counter', 'Tasks turned down with a busy reply.')):
+        lines.extend([f'# HELP smarthomebot_{metric} {metric_help}', f'# TYPE smarthomebot_{metric} {metric_type}'])
+        lines.extend(f'smarthomebot_{metric}{{pool="{pool_name}"}} {pool_state[key]}' for pool_name, pool_state in pool_states.items())
+    return lines
+
+# webhook server
+# lightweight local HTTP server receiving Telegram updates. The secret token header is checked before
+# the body is decoded, and updates are put straight on the dispatcher queue. With process_inline the
+# update is handled before replying, so a local client can time end-to-end handling latency.
+class WebhookHandler:
+    def do_POST(self) -> None:
+        webhook = self.server.webhook
+        if self.path != webhook.path:
+            self.send_error(404)
+            return
+        if webhook.secret_token and not hmac.compare_digest(self.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), webhook.secret_token):
+            self.send_error(403)
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            update = Update.de_json(json.loads(self.rfile.read(content_length)), webhook.bot)
+        except (ValueError, TypeError):
+            self.send_error(400)
+            return
+        if webhook.process_inline:
+            webhook.dispatcher.process_update(update)
+        else:
+            webhook.update_queue.put(update)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args) -> None:
+        logger.debug('Webhook %s - %s', self.address_string(), format % args)
+
+class WebhookServer:
+    def __init__(self, bot, dispatcher, update_queue, listen='127.0.0.1', port=8443, path='/telegram', secret_token='', process_inline=False):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.update_queue = update_queue
+        self.path = path
+        self.secret_token = secret_token
+        self.process_inline = process_inline
+        self.httpd = http_server(listen, port, WebhookHandler)
+        self.httpd.webhook = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='webhook-server', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+webhook_server = None
+
+# event ingestion
+# home scripts POST JSON events ({"source": ..., "message": ...}, or a list of them) to a local HTTP
+# endpoint. Events are validated and queued without touching the dispatcher, duplicates by key are
+# dropped within dedup_window secs, and events of a source are coalesced into one message per window.
+class EventAggregator:
+    def __init__(self, dedup_window=60, coalesce_window=5, max_keys=10000):
+        self.dedup_window = dedup_window
+        self.coalesce_window = coalesce_window
+        self.max_keys = max_keys
+        self.seen = OrderedDict()
+        self.pending = {}
+        self.accepted = self.duplicates = self.rejected = self.delivered = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='event-aggregator', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def validate(self, event):
+        if not isinstance(event, dict):
+            return 'event must be a JSON object'
+        if not isinstance(event.get("source"), str) or event.get("source").strip() == '':
+            return 'source must be a non empty string'
+        if "metrics" in event and not isinstance(event.get("metrics"), dict):
+            return 'metrics must be a JSON object'
+        if "metrics" not in event and (not isinstance(event.get("message"), str) or event.get("message").strip() == ''):
+            return 'message must be a non empty string'
+        if event.get("priority", 'reply') not in ('alarm', 'reply'):
+            return 'priority must be alarm or reply'
+        return None
+
+    def add(self, event) -> str:
+        if self.validate(event) is not None:
+            with self.lock:
+                self.rejected += 1
+            return 'rejected'
+        source = event["source"].strip()
+        # metrics are fed to alert rules, events with only metrics are not notified
+        if event.get("metrics") and rule_engine is not None:
+            rule_engine.feed(event["metrics"])
+        if not isinstance(event.get("message"), str) or event.get("message").strip() == '':
+            with self.lock:
+                self.accepted += 1
+            return 'accepted'
+        message = event["message"].strip()
+        dedup_key = str(event.get("key") or f'{source}:{message}')
+        now = time.monotonic()
+        with self.lock:
+            seen_at = self.seen.get(dedup_key)
+            if seen_at is not None and now - seen_at < self.dedup_window:
+                self.duplicates += 1
+                return 'duplicate'
+            self.seen[dedup_key] = now
+            self.seen.move_to_end(dedup_key)
+            while len(self.seen) > self.max_keys:
+                self.seen.popitem(last=False)
+            pending = self.pending.setdefault(source, {"messages" : OrderedDict(), "priority" : 'reply'})
+            pending["messages"][message] = pending["messages"].get(message, 0) + 1
+            if event.get("priority") == 'alarm':
+                pending["priority"] = 'alarm'
+            self.accepted += 1
+        return 'accepted'
+
+    def run(self) -> None:
+        while not self.stopping.wait(self.coalesce_window):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            # forget expired dedup keys, oldest first
+            deadline = time.monotonic() - self.dedup_window
+            while self.seen and next(iter(self.seen.values())) < deadline:
+                self.seen.popitem(last=False)
+        for source, source_events in pending.items():
+            lines = [message if count == 1 else f'{message} (x{count})' for message, count in source_events["messages"].items()]
+            event_msg = f'{source}: {lines[0]}' if len(lines) == 1 else f'{source}:\n' + '\n'.join(lines)
+            for event_chat_id in event_chats():
+                send_message(event_chat_id, event_msg, source_events["priority"])
+            self.delivered += 1
+
+def event_chats() -> list:
+    return allowed_chats
+
+class EventHandler:
+    def do_POST(self) -> None:
+        event_server = self.server.event_server
+        if self.path != event_server.path:
+            self.send_error(404)
+            return
+        if event_server.token and not hmac.compare_digest(self.headers.get('X-SmartHomeBot-Token', ''), event_server.token):
+            self.send_error(403)
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            events = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            self.send_error(400)
+            return
+        if not isinstance(events, list):
+            events = [events]
+        results = [event_server.aggregator.add(event) for event in events]
+        response = json.dumps({result : results.count(result) for result in ('accepted', 'duplicate', 'rejected')}).encode('utf-8')
+        self.send_response(202 if 'rejected' not in results else 400)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args) -> None:
+        logger.debug('Events %s - %s', self.address_string(), format % args)
+
+class EventServer:
+    def __init__(self, aggregator, listen='127.0.0.1', port=8444, path='/events', token=''):
+        self.aggregator = aggregator
+        self.path = path
+        self.token = token
+        self.httpd = http_server(listen, port, EventHandler)
+        self.httpd.event_server = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='event-server', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+event_aggregator = None
+event_server = None
+
+# handler engine
+# with ENGINE.mode set to run_async, the dispatcher hands updates over to the library's own pool of
+# max_concurrent_updates worker threads instead of handling them one at a time on its own thread.
+# asyncio is the older name of the same mode.
+engine_modes = ('run_async', 'asyncio')
+run_async = False
+
+def engine_handler(callback):
+    # handlers are timed wherever they run, run_async is passed to the handler itself
+    return stats_handler(callback)
+
 # filter handlers
 def not_allowed_users(update: Update, context: CallbackContext) -> None:
     parsed_command, parsed_command_arg, parsed_command_error, user_id, chat_id = command_parser(update, context)
-    if parsed_command == '/join' and parsed_command_arg not in banned_users:
-        check_chatmember(user_id)
-        join_command(update, context)
+    check_chatmember(user_id, chat_id)
+    is_banned = chat_directory(chat_id).is_banned(user_id)
+    if parsed_command == '/join' and not is_banned:
+        join_command(update, context, parsed_command, parsed_command_arg, chat_id)
     else:
-        check_chatmember(user_id)
-        update.message.reply_text('Sorry you\'re not allowed to use this bot, but you can use /join command to request access to an admin.')
+        reply_text(update, 'Sorry you\'re not allowed to use this bot, but you can use /join command to request access to an admin.')
+    flood_control.reject(user_id, chat_id, not is_banned)
 
 def not_command(update: Update, context: CallbackContext) -> None:
     parsed_command, parsed_command_arg, parsed_command_error, user_id, chat_id = command_parser(update, context)
-    check_chatmember(user_id)
-    update.message.reply_text('Sorry, I can\'t understand that.')
+    check_chatmember(user_id, chat_id)
+    reply_text(update, 'Sorry, I can\'t understand that.')
 
 def check_command(update: Update, context: CallbackContext) -> None:
     parsed_command, parsed_command_arg, parsed_command_error, user_id, chat_id = command_parser(update, context)
     if parsed_command_error == True:
         return
-    elif parsed_command not in commands:
-        update.message.reply_text('Sorry that\'s not a real command. Check /help for available commands.')
-    elif parsed_command in super_commands:
-        if user_id in admin_users:
-            admin_commands(update, context, parsed_command, parsed_command_arg, chat_id)
-        else:
-            not_admin(update, context)
-    elif parsed_command in commands:
-        user_commands(update, context, parsed_command, parsed_command_arg, chat_id)
+    command_entry = command_dict.get(parsed_command)
+    if command_entry is None:
+        reply_text(update, 'Sorry that\'s not a real command. Check /help for available commands.')
+    elif command_entry["role"] == 'admin' and not chat_directory(chat_id).is_admin(user_id):
+        not_admin(update, context)
+    elif not check_argument(command_entry, parsed_command_arg):
+        reply_text(update, f'The argument is not valid. Usage: {command_usage(parsed_command)}')
+    else:
+        if not run_on_pool(command_entry["pool"], stats.timed, 'command', parsed_command, command_entry["handler"], update, context, parsed_command, parsed_command_arg, chat_id):
+            reply_text(update, pool_busy_text)
 
 def not_admin(update: Update, context: CallbackContext) -> None:
-    update.message.reply_text('Sorry, you\'re not an admin, you can\'t use admin restricted commands.')
+    reply_text(update, 'Sorry, you\'re not an admin, you can\'t use admin restricted commands.')
 
 # command handlers
-def user_commands(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
-    if parsed_command == '/start':
-        start_command(update, context)
-    elif parsed_command == '/help':
-        help_command(update, context, parsed_command_arg)
-    elif parsed_command == '/listusers' or parsed_command == '/adminusers' or parsed_command == '/chatmembers':
-        listusers_command(update, context, parsed_command, chat_id)
-    elif parsed_command == '/join':
-        join_command(update, context, parsed_command)
-    elif parsed_command == '/time':
-        time_command(update, context, parsed_command, chat_id)
-    elif parsed_command == '/timer' or parsed_command == '/alarm':
-        timer_command(update, context, parsed_command, parsed_command_arg)
-
-def admin_commands(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
-    if parsed_command == '/admincommands':
-        help_admin_command(update, context)
-    elif parsed_command == '/requests':
-        requests_command(update, context, parsed_command, chat_id)
-    elif parsed_command == '/dismiss':
-        dismiss_command(update, context, parsed_command, parsed_command_arg)
-    elif parsed_command == '/adduser' or parsed_command == '/removeuser' or parsed_command == '/banuser' or parsed_command == '/unban' or parsed_command == '/makeadmin' or parsed_command == '/revokeadmin':
-        anyuser_command(update, context, parsed_command, parsed_command_arg)
-    elif parsed_command == '/banlist':
-        listusers_command(update, context, parsed_command, chat_id)
-    elif parsed_command == '/version':
-        version_command(update, context)
-    elif parsed_command == '/system':
-        system_command(update, context, parsed_command, chat_id)
-    elif parsed_command == '/reboot':
-        reboot_command(update, context, parsed_command, parsed_command_arg)
-
-def start_command(update: Update, context: CallbackContext) -> None:
-    update.message.reply_text('SmartHomeBot is running. Type /help to list all available commands.')
-
-def help_command(update: Update, context: CallbackContext, parsed_command_arg) -> None:
+def start_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    reply_text(update, 'SmartHomeBot is running. Type /help to list all available commands.')
+
+def help_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
     if parsed_command_arg is None:
-        update.message.reply_markdown_v2(help_str)
-    elif parsed_command_arg == 'timer':
-        update.message.reply_markdown_v2(help_timer_str)
-    elif parsed_command_arg == 'alarm':
-        update.message.reply_markdown_v2(help_alarm_str)
+        reply_markdown_v2(update, help_pages.get('user'))
+    else:
+        reply_markdown_v2(update, help_pages.get(parsed_command_arg))
 
-def help_admin_command(update: Update, context: CallbackContext) -> None:
-    update.message.reply_markdown_v2(help_admin_str)
+def help_admin_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    reply_markdown_v2(update, help_pages.get('admin'))
 
-def listusers_command(update: Update, context: CallbackContext, parsed_command, chat_id) -> None:
+def listusers_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
     listusers_msg = ''
     if parsed_command == '/listusers' or parsed_command == '/adminusers' or parsed_command == '/chatmembers' or parsed_command == '/banlist':
         listusers_msg = listusers_dict.get(parsed_command)
     listusers_msg += users_list(update, parsed_command, chat_id)
-    update.message.reply_markdown_v2(listusers_msg)
-
-def join_command(update: Update, context: CallbackContext, parsed_command) -> None:
-    chat_info = update.message['chat']
-    user_id = chat_info['id']
-    if user_id in allowed_users:
-        update.message.reply_text('You are already in allowed users list.')
-    elif user_id in user_requests:
-        update.message.reply_text('Your request is still pending for approval.')
+    reply_markdown_v2(update, listusers_msg, 'listing')
+
+def join_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    user_id = update.message.from_user.id
+    user_directory = chat_directory(chat_id)
+    if user_directory.is_allowed(user_id):
+        reply_text(update, 'You are already in allowed users list.')
+    elif user_directory.has('user_requests', user_id):
+        reply_text(update, 'Your request is still pending for approval.')
     else:
-        keyboard_markup = keyboard_construct('yes_no')
-        update.message.reply_text('Are you sure?', reply_markup=keyboard_markup)
+        ask_confirmation(update, parsed_command, parsed_command_arg, chat_id)
 
-def time_command(update: Update, context: CallbackContext, parsed_command, chat_id) -> None:
+def time_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
     time_msg = time.strftime("%a %d/%m/%Y %H:%M %z", time.localtime())
-    update.message.reply_text(time_msg)
-
-def timer_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg) -> None:
-    def timer_callback():
-        timer_string, timer_start, timer_stop = timer_stringify(parsed_command, parsed_command_arg)
-        update.message.reply_text(f'{timer_stop}')
-        if parsed_command == '/timer':
-            timers.remove(timer_string)
-            timers_data.update({"timers" : timers})
-        elif parsed_command == '/alarm':
-            alarms.remove(timer_string)
-            timers_data.update({"alarms" : alarms})
-        config.update({"TIMERS" : timers_data})
-        store_config(config)
-        read_config()
+    reply_text(update, time_msg)
 
+def timer_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
     def timer_stringify(parsed_command, parsed_command_arg):
         timer_callback_answer = timers_dict.get(parsed_command)
         timer_start_string = timer_callback_answer.get('timer_start')
@@ -240,13 +2274,10 @@ def timer_command(update: Update, context: CallbackContext, parsed_command, pars
                 timer_string = parsed_command_arg
             timer_start = f'{timer_string} {timer_start_string}'
         elif parsed_command == '/alarm':
-            alarm_day = later.day
-            alarm_month = later.month
-            alarm_year = later.year
-            if alarm_day == now.day:
-                timer_string = f'{time_hour:02d}:{time_minute:02d}'
+            if later.date() == now.date():
+                timer_string = f'{later.hour:02d}:{later.minute:02d}'
             else:
-                timer_string = f'{alarm_day:02d}/{alarm_month:02d}/{alarm_year:04d} {time_hour:02d}:{time_minute:02d}'
+                timer_string = f'{later.day:02d}/{later.month:02d}/{later.year:04d} {later.hour:02d}:{later.minute:02d}'
             timer_start = f'{timer_start_string} {timer_string}'
         timer_stop = f'{timer_string} {timer_stop_string}'
         return timer_string, timer_start, timer_stop
@@ -256,311 +2287,548 @@ def timer_command(update: Update, context: CallbackContext, parsed_command, pars
             timer_error_msg = '``/help timer``'
         if parsed_command == '/alarm':
             timer_error_msg = '``/help alarm``'
-        update.message.reply_markdown_v2(f'Time argument is malformed\. Check {timer_error_msg} for more info\.')
-        return True
+        reply_markdown_v2(update, f'Time argument is malformed\. Check {timer_error_msg} for more info\.')
+        return None
 
-    def timer_list(parsed_command, later):
-        timers_data = config.get("TIMERS")
-        timers = timers_data.get("timers")
-        alarms = timers_data.get("alarms")
-        timer_count = len(timers)
-        alarm_count = len(alarms)
-        timer_data = ''
+    def timer_list(parsed_command):
+        render_key = (parsed_command, chat_id, timer_scheduler.version)
+        cached = render_cache.get(render_key)
+        if cached is not None:
+            timer_count, timer_data = cached
+        else:
+            entries = timer_scheduler.list(parsed_command, chat_id)
+            timer_count = len(entries)
+            timer_data = join_words([f'{entry["label"]} (id {entry["id"]})' for entry in entries])
+            render_cache.put(render_key, (timer_count, timer_data))
         if parsed_command == '/timer':
             timer_type = 'timers'
             timer_type_single = 'is a timer'
             timer_type_plural = f'are {timer_count} timers'
-            for x in timers:
-                if timer_count > 2 and timers.index(x) < timer_count-2:
-                    timer_data += f'{x}, '
-                if timer_count-2 == timers.index(x):
-                    timer_data += f'{x} and '
-                if timer_count-1 == timers.index(x):
-                    timer_data += f'{x}'
         elif parsed_command == '/alarm':
             timer_type = 'alarms'
             timer_type_single = 'is an alarm'
-            timer_type_plural = f'are {alarm_count} alarms'
-            for x in alarms:
-                if alarm_count > 2 and alarms.index(x) < alarm_count-2:
-                    timer_data += f'{x}, '
-                if alarm_count-2 == alarms.index(x):
-                    timer_data += f'{x} and '
-                if alarm_count-1 == alarms.index(x):
-                    timer_data += f'{x}'
-        if timer_count == 0 and parsed_command == '/timer':
-            update.message.reply_text(f'There aren\'t configured {timer_type} at all.')
-        elif timer_count == 1 and parsed_command == '/timer':
-            update.message.reply_text(f'There {timer_type_single} configured for {timer_data}')
-        elif alarm_count == 0 and parsed_command == '/alarm':
-            update.message.reply_text(f'There aren\'t configured {timer_type} at all.')
-        elif alarm_count == 1 and parsed_command == '/alarm':
-            update.message.reply_text(f'There {timer_type_single} configured for {timer_data}')    
+            timer_type_plural = f'are {timer_count} alarms'
+        if timer_count == 0:
+            reply_text(update, f'There aren\'t configured {timer_type} at all.')
+        elif timer_count == 1:
+            reply_text(update, f'There {timer_type_single} configured for {timer_data}', 'listing')
         else:
-            update.message.reply_text(f'There {timer_type_plural} configured for {timer_data}')
+            reply_text(update, f'There {timer_type_plural} configured for {timer_data}', 'listing')
+
+    def timer_cancel(parsed_command, timer_arg):
+        timer_name = timers_dict.get(parsed_command).get('timer_name')
+        if not timer_arg.isdigit():
+            reply_text(update, f'You must provide the id of the {timer_name.lower()} to cancel, check /{timer_name.lower()} for ids.')
+            return
+        timer_id = int(timer_arg)
+        entry = timer_scheduler.get(timer_id)
+        if entry is None or entry["kind"] != parsed_command or entry["partition"] != chat_id:
+            reply_text(update, f'There\'s no {timer_name.lower()} with id {timer_id}.')
+        elif entry["owner"] != user_id and not chat_directory(chat_id).is_admin(user_id):
+            reply_text(update, f'You can only cancel your own {timer_name.lower()}s.')
+        elif timer_scheduler.cancel(timer_id) is None:
+            reply_text(update, f'The {timer_name.lower()} with id {timer_id} has already ended.')
+        else:
+            state_store.delete_timer(timer_id)
+            reply_text(update, f'{timer_name} {entry["label"]} (id {timer_id}) cancelled.')
 
     def timer_check(parsed_command, parsed_command_arg):
-        global timer
-        time_error = False
-        time_day = now.day
-        time_hour = now.hour
-        time_minute = now.minute
-        time_second = now.second
-        if time_error is False:
-            if parsed_command_arg.find(':') > -1:
-                parsed_time = parsed_command_arg.rsplit(":")
-                if len(parsed_time) > 2:
-                    time_error = timer_error(parsed_command)
-                elif parsed_command == '/timer':
-                    time_hour = now.hour + int(parsed_time[0])
-                    time_minute = now.minute + int(parsed_time[1])
-                elif parsed_command == '/alarm':
-                    time_hour = int(parsed_time[0])
-                    time_minute = int(parsed_time[1])
-                    time_second = 0
-                    if time_minute > 59 or time_hour > 23:
-                        time_error = timer_error(parsed_command)
-                    elif time_hour < now.hour:
-                        time_day = now.day + 1
-            elif parsed_command == "/timer":
-                if parsed_command_arg.endswith("s") is True:
-                    time_second = now.second + int(parsed_command_arg.replace("s", ""))
-                elif parsed_command_arg.endswith("m") == True:
-                    time_minute = now.minute + int(parsed_command_arg.replace("m", ""))
-                elif parsed_command_arg.endswith("h") == True:
-                    time_hour = now.hour + int(parsed_command_arg.replace("h", ""))
+        # due datetime of the argument, None if it's malformed. Adding a timedelta carries over to
+        # the next day, month or year
+        if parsed_command == '/timer':
+            parsed_time = parsed_command_arg.rsplit(":")
+            try:
+                if len(parsed_time) == 2 and parsed_time[0].isdigit() and parsed_time[1].isdigit():
+                    timer_delta = timedelta(hours=int(parsed_time[0]), minutes=int(parsed_time[1]))
+                elif parsed_command_arg[:-1].isdigit() and parsed_command_arg[-1] in timer_units_dict:
+                    timer_delta = timedelta(**{timer_units_dict.get(parsed_command_arg[-1]) : int(parsed_command_arg[:-1])})
                 else:
-                    time_error = timer_error(parsed_command)
-            if time_second > 59:
-                corrected_minute = math.floor(time_second/60)
-                time_second = math.floor(time_second - corrected_minute*60)
-                time_minute = now.minute + corrected_minute
-            if time_minute > 59:
-                corrected_hour = math.floor(time_minute/60)
-                time_minute = math.floor(time_minute - corrected_hour*60)
-                time_hour = now.hour + corrected_hour
-            if time_hour > 23:
-                time_day = now.day + math.floor(time_hour/24)
-                time_hour = math.floor(time_hour - time_day*24)
-            return time_day, time_hour, time_minute, time_second, time_error
-        elif time_error == True:
-            return time_day, time_hour, time_minute, time_second, time_error
-
-    def timer_start(total_secs, later, parsed_command, parsed_command_arg):
+                    return timer_error(parsed_command)
+                return now + timer_delta
+            except (OverflowError, ValueError):
+                # too long for datetime, or too many digits for int
+                return timer_error(parsed_command)
+        alarm_time = parse_clock(parsed_command_arg)
+        if alarm_time is None:
+            return timer_error(parsed_command)
+        later = now.replace(hour=alarm_time[0], minute=alarm_time[1], second=0, microsecond=0)
+        if later <= now:
+            later += timedelta(days=1)
+        return later
+
+    def recurring_check(parsed_command_arg):
+        # cron expression of a recurring alarm and its first due time, None if it's malformed
+        schedule_words = parsed_command_arg.split()
+        if schedule_words[0] == 'cron':
+            schedule = ' '.join(schedule_words[1:])
+        elif len(schedule_words) == 2 and parse_clock(schedule_words[1]) is not None:
+            alarm_hour, alarm_minute = parse_clock(schedule_words[1])
+            schedule = f'{alarm_minute} {alarm_hour} * * {recurring_dict.get(schedule_words[0])}'
+        else:
+            return timer_error(parsed_command)
+        try:
+            next_due = next_fire_time(schedule, time.time())
+        except ValueError:
+            next_due = None
+        if next_due is None:
+            return timer_error(parsed_command)
+        return schedule, next_due
+
+    def recurring_start(parsed_command_arg):
+        checked = recurring_check(parsed_command_arg)
+        if checked is None:
+            return
+        schedule, next_due = checked
+        entry = {
+            "kind" : parsed_command,
+            "label" : ' '.join(parsed_command_arg.split()),
+            "due" : next_due,
+            "owner" : user_id,
+            "chat_id" : update.message.chat_id,
+            "message_id" : update.message.message_id,
+            "partition" : chat_id,
+            "schedule" : schedule
+        }
+        timer_id = timer_scheduler.schedule(entry)
+        next_time = datetime.fromtimestamp(next_due).strftime('%d/%m/%Y %H:%M')
+        reply_text(update, f'{timers_dict.get(parsed_command).get("timer_start")} {entry["label"]}, next on {next_time} (id {timer_id})')
+        state_store.save_timer(entry)
+
+    def timer_start(later, parsed_command, parsed_command_arg):
         timer_string, timer_start, timer_stop = timer_stringify(parsed_command, parsed_command_arg)
-        timer = threading.Timer(total_secs, timer_callback)
-        update.message.reply_text(f'{timer_start}')
-        timer.start()
-        if parsed_command == '/timer':
-            timers.append(timer_string)
-            timers_data.update({"timers" : timers})
-        elif parsed_command == '/alarm':
-            alarms.append(timer_string)
-            timers_data.update({"alarms" : alarms})
-        config.update({"TIMERS" : timers_data})
-        store_config(config)
-        read_config()
-        return timer
-    
-    global timer
+        entry = {
+            "kind" : parsed_command,
+            "label" : timer_string,
+            "due" : later.timestamp(),
+            "owner" : user_id,
+            "chat_id" : update.message.chat_id,
+            "message_id" : update.message.message_id,
+            "partition" : chat_id
+        }
+        timer_id = timer_scheduler.schedule(entry)
+        reply_text(update, f'{timer_start} (id {timer_id})')
+        state_store.save_timer(entry)
+        return timer_id
+
+    user_id = update.message.from_user.id
     if parsed_command_arg is None:
-        timer_list(parsed_command, None)
+        timer_list(parsed_command)
+    elif parsed_command_arg.startswith('cancel'):
+        timer_cancel(parsed_command, parsed_command_arg[len('cancel'):].strip())
+    elif parsed_command == '/alarm' and parsed_command_arg.split()[0] in ('cron', *recurring_dict):
+        recurring_start(parsed_command_arg)
     else:
         now = datetime.now()
-        time_day, time_hour, time_minute, time_second, time_error = timer_check(parsed_command, parsed_command_arg)
-        later = datetime(now.year, now.month, time_day, hour=time_hour, minute=time_minute, second=time_second)
-        if time_error is False:
-            difference = (later - now)
-            total_secs = round(difference.total_seconds())
-            timer = timer_start(total_secs, later, parsed_command, parsed_command_arg)
-        else:
-            pass
+        later = timer_check(parsed_command, parsed_command_arg)
+        if later is not None:
+            timer_start(later, parsed_command, parsed_command_arg)
 
-def requests_command(update: Update, context: CallbackContext, parsed_command, chat_id) -> None:
-    if len(user_requests) == 0:
-        update.message.reply_text('There are not pending requests.')
+def requests_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    user_directory = chat_directory(chat_id)
+    if user_directory.count('user_requests') == 0:
+        reply_text(update, 'There are not pending requests.')
+    elif parsed_command_arg == 'approve all':
+        bulk_confirmation(update, '/adduser', user_directory.users('user_requests'), chat_id)
+    elif parsed_command_arg == 'dismiss all':
+        bulk_confirmation(update, '/dismiss', user_directory.users('user_requests'), chat_id)
     else:
-        requests_msg = 'There are ' + str(len(user_requests)) + ' pending requests\.\n\n'
-        requests_msg += users_list(parsed_command, chat_id)
+        requests_msg = 'There are ' + str(user_directory.count('user_requests')) + ' pending requests\.\n\n'
+        requests_msg += users_list(update, '/requests', chat_id)
         requests_msg += '\nUse \/adduser to add them into allowed users list, or \/dismiss user\_id to reject the request\.\n'
-        update.message.reply_markdown_v2(requests_msg)
+        reply_markdown_v2(update, requests_msg, 'listing')
 
-def dismiss_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg) -> None:
-    if len(user_requests) == 0:
-        update.message.reply_text('There are not pending requests.')
+def dismiss_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    if chat_directory(chat_id).count('user_requests') == 0:
+        reply_text(update, 'There are not pending requests.')
     else:
-        anyuser_command(update, context, parsed_command, parsed_command_arg)
-        requests_command(update, context, parsed_command, parsed_command_arg)
+        anyuser_command(update, context, parsed_command, parsed_command_arg, chat_id)
+        requests_command(update, context, '/requests', None, chat_id)
 
-def anyuser_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg) -> None:
-    if parsed_command_arg == None:
-        update.message.reply_text('You haven\'t provided user_id argument.')
+def anyuser_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    user_ids = parse_user_ids(parsed_command_arg)
+    if len(user_ids) == 1:
+        ask_confirmation(update, parsed_command, str(user_ids[0]), chat_id)
     else:
-        keyboard_markup = keyboard_construct('yes_no')
-        update.message.reply_text('Are you sure?', reply_markup=keyboard_markup)
+        bulk_confirmation(update, parsed_command, user_ids, chat_id)
 
-def reboot_command(update: Update, context: CallbackContext, parsed_command, *parsed_command_arg) -> None:
-    keyboard_markup = keyboard_construct('yes_no')
-    update.message.reply_text('Reboot your system?', reply_markup=keyboard_markup)
+def bulk_confirmation(update: Update, parsed_command, user_ids, chat_id) -> None:
+    # the whole batch is checked first, and a single confirmation sums up what will change
+    if len(user_ids) > bulk_max_users:
+        reply_text(update, f'Too many users, at most {bulk_max_users} can be changed at once.')
+        return
+    valid_ids, skipped = check_user_changes(chat_directory(chat_id), parsed_command, user_ids, update.message.from_user.id)
+    if len(valid_ids) == 0:
+        reply_text(update, 'There\'s nothing to change.' + skipped_summary(skipped))
+        return
+    bulk_question, bulk_answer = bulk_dict.get(parsed_command)
+    ask_confirmation(update, parsed_command, valid_ids, chat_id, bulk_question.format(count=len(valid_ids)) + skipped_summary(skipped))
+
+def parse_user_ids(text):
+    # user ids separated by spaces, commas or semicolons, None if any of them is not a number
+    user_ids = [user_id for user_id in re.split(r'[\s,;]+', text or '') if user_id != '']
+    if len(user_ids) == 0 or not all(user_id.isdigit() for user_id in user_ids):
+        return None
+    return [int(user_id) for user_id in user_ids]
+
+def parse_user_csv(data) -> list:
+    # first number of every row, so header rows and extra columns like names are skipped
+    user_ids = []
+    for row in csv.reader(io.StringIO(data.decode('utf-8-sig', errors='replace'))):
+        for field in row:
+            if field.strip().isdigit():
+                user_ids.append(int(field.strip()))
+                break
+    return user_ids
 
-def system_command(update: Update, context: CallbackContext, parsed_command, chat_id) -> None:
-    # skip CPU temperature if OS is not Linux.
-    if psutil.LINUX == False:
-        system_msg = '*CPU temperature:* _Not available_\n'
+def document_command(update: Update, context: CallbackContext) -> None:
+    # a CSV file of user ids sent with a user management command as caption, e.g. /adduser
+    message = update.message
+    caption = (message.caption or '').split()
+    parsed_command = caption[0] if len(caption) > 0 else None
+    command_entry = command_dict.get(parsed_command)
+    chat_id = chat_partitions.route(message)
+    if command_entry is None or command_entry["arg"] != 'user_ids':
+        reply_text(update, 'Send a CSV file of user ids with /adduser, /removeuser, /banuser, /unban, /makeadmin, /revokeadmin or /dismiss as caption.')
+    elif not chat_directory(chat_id).is_admin(message.from_user.id):
+        not_admin(update, context)
+    elif message.document.file_size is not None and message.document.file_size > upload_max_size:
+        reply_text(update, f'The file is too big, it can be up to {upload_max_size // 1024} KB.')
+    elif not run_on_pool('io', stats.timed, 'command', 'upload', upload_user_ids, update, context, parsed_command, chat_id):
+        reply_text(update, pool_busy_text)
+
+def upload_user_ids(update: Update, context: CallbackContext, parsed_command, chat_id) -> None:
+    data = stats.timed('api', 'get_file', bot.get_file, update.message.document.file_id).download_as_bytearray()
+    user_ids = parse_user_csv(bytes(data))
+    if len(user_ids) == 0:
+        reply_text(update, 'There are no user ids in the file.')
+        return
+    command_dict.get(parsed_command)["handler"](update, context, parsed_command, ' '.join(str(user_id) for user_id in user_ids), chat_id)
+
+def reboot_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    ask_confirmation(update, parsed_command, parsed_command_arg, chat_id, 'Reboot your system?')
+
+def system_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    if parsed_command_arg is not None and parsed_command_arg.startswith('history'):
+        system_history(update, parsed_command_arg[len('history'):].strip())
+        return
+    sample = system_sampler.latest()
+    if sample is None:
+        reply_text(update, 'System metrics are not available yet, try again in a few seconds.')
+        return
+    system_msg = ''
+    for metric, (metric_name, metric_unit) in system_metrics.items():
+        # skip CPU temperature if OS is not Linux.
+        if sample[metric] is None:
+            system_msg += f'*{metric_name}:* _Not available_\n'
+        else:
+            metric_esc = markdown_escape(round(sample[metric], 1))
+            system_msg += f'*{metric_name}:* {metric_esc}{metric_unit}\n'
+    reply_markdown_v2(update, system_msg.rstrip('\n'))
+
+def system_history(update: Update, history_arg) -> None:
+    if history_arg == '':
+        minutes = system_data.get("history_minutes", 60)
+    elif history_arg.isdigit() and int(history_arg) > 0:
+        minutes = int(history_arg)
     else:
-        Bot.SetChatAction(chat_id, 'typing')
-        cpu_temp = CPUTemperature()
-        cpu_temp_esc = re.escape(str(round(cpu_temp.temperature, 1)))
-        system_msg = '*CPU temperature:* ' + cpu_temp_esc + '°C\n'
-    cpu_load = psutil.cpu_percent(4)
-    cpu_load_esc = re.escape(str(round(cpu_load, 1)))
-    ram_load = psutil.virtual_memory()
-    ram_load_esc = re.escape(str(round(ram_load.percent, 1)))
-    system_msg += '*CPU load:* ' + cpu_load_esc + '%\n'
-    system_msg += '*RAM load:* ' + ram_load_esc + '%'
-    update.message.reply_markdown_v2(system_msg)
-
-def version_command(update: Update, context: CallbackContext) -> None:
-    github_info = requests.get("https://api.github.com/repos/Geek-MD/SmartHomeBot/releases/latest")
-    github_version = github_info.json()["name"]
+        reply_text(update, 'History length must be a number of minutes, e.g. /system history 30')
+        return
+    samples = system_sampler.history(minutes)
+    if len(samples) == 0:
+        reply_text(update, 'There are no system samples yet, try again in a few seconds.')
+        return
+    system_msg = f'*Last {minutes} min* \\({len(samples)} samples\\)\n'
+    for metric, (metric_name, metric_unit) in system_metrics.items():
+        values = [sample[metric] for sample in samples if sample[metric] is not None]
+        if len(values) == 0:
+            system_msg += f'*{metric_name}:* _Not available_\n'
+            continue
+        metric_stats = [markdown_escape(round(value, 1)) + metric_unit for value in (min(values), sum(values) / len(values), max(values))]
+        system_msg += f'*{metric_name}:* min {metric_stats[0]} avg {metric_stats[1]} max {metric_stats[2]}\n{sparkline(values)}\n'
+    reply_markdown_v2(update, system_msg.rstrip('\n'))
+
+def rules_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    rules = rule_engine.status() if rule_engine is not None else []
+    if len(rules) == 0:
+        reply_text(update, 'There aren\'t configured rules at all.')
+        return
+    rules_msg = '*Alert rules:*\n'
+    for rule in rules:
+        rule_state = 'active' if rule["active"] else 'idle'
+        rules_msg += f'{markdown_escape(rule["name"])} \\- `{markdown_escape(rule["condition"])}` \\- {rule_state}, fired {rule["count"]} times\n'
+    reply_markdown_v2(update, rules_msg, 'listing')
+
+def broadcast_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    recipients = chat_directory(chat_id).users('allowed_users')
+    broadcast_count = {"done" : 0, "failed" : 0}
+    broadcast_lock = threading.Lock()
+    def broadcast_sent(future) -> None:
+        with broadcast_lock:
+            broadcast_count["done"] += 1
+            if future.exception() is not None:
+                broadcast_count["failed"] += 1
+            if broadcast_count["done"] < len(recipients):
+                return
+        delivered = broadcast_count["done"] - broadcast_count["failed"]
+        reply_text(update, f'Broadcast delivered to {delivered} of {len(recipients)} users.')
+    reply_text(update, f'Broadcasting to {len(recipients)} users.')
+    for recipient in recipients:
+        send_message(recipient, parsed_command_arg, 'broadcast').add_done_callback(broadcast_sent)
+
+def stats_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
+    snapshot = stats.snapshot()
+    if len(snapshot) == 0 and sum(flood_control.dropped.values()) == 0 and len(worker_pools) == 0:
+        reply_text(update, 'There are no stats yet.')
+        return
+    uptime = int(time.time() - stats.started)
+    stats_msg = f'*Handler stats* \\- up {uptime // 3600}h {uptime % 3600 // 60}m\n'
+    for kind, kind_name in stats_kinds_dict.items():
+        kind_series = [series for series in snapshot if series["kind"] == kind]
+        if len(kind_series) == 0:
+            continue
+        stats_msg += f'\n*{kind_name}:*\n'
+        for series in kind_series:
+            timings = [f'{seconds * 1000:.1f}' for seconds in (series["sum"] / series["count"], stats.quantile(series, 0.95), series["max"])]
+            stats_msg += markdown_escape(f'{series["name"]} - {series["count"]} calls, {series["errors"]} errors, avg {timings[0]} p95 {timings[1]} max {timings[2]} ms') + '\n'
+    if len(worker_pools) > 0:
+        stats_msg += '\n*Worker pools:*\n'
+    for pool_name, pool in worker_pools.items():
+        pool_state = pool.state()
+        stats_msg += markdown_escape(f'{pool_name} - {pool_state["running"]} of {pool_state["workers"]} workers busy, {pool_state["queued"]} of {pool_state["max_queue"]} queued, {pool_state["rejected"]} busy replies') + '\n'
+    stats_msg += '\n*Flood control:*\n'
+    for reason, reason_name in flood_reasons_dict.items():
+        stats_msg += markdown_escape(f'{reason_name} - {flood_control.dropped[reason]} dropped') + '\n'
+    banned = flood_control.banned()
+    stats_msg += markdown_escape(f'{flood_control.banned_total} temporary bans, {len(banned)} running') + '\n'
+    for user_id, secs_left in banned:
+        stats_msg += markdown_escape(f'{user_id} - {secs_left // 60}m left') + '\n'
+    reply_markdown_v2(update, stats_msg, 'listing')
+
+def version_command(update: Update, context: CallbackContext, parsed_command, parsed_command_arg, chat_id) -> None:
     version_msg = f'Local version is {bot_version}\n'
-    version_msg += f'Github version is {github_version}\n'
-    if bot_version < github_version:
-        version_msg += f'\nThere\'s a new version of the bot available at GitHub ({github_version})\nUpdate bot version following Wiki instructions.'
-    elif bot_version == github_version:
-        version_msg += f'\nBot version is up to date'
-    elif bot_version > github_version:
-        version_msg += f'\nLocal version is ahead of GitHub version.'
-    update.message.reply_text(version_msg)
+    github_version = release_checker.version
+    if release_checker.offline:
+        version_msg += f'\nRelease check is disabled, bot is in offline mode.'
+    elif github_version is None:
+        version_msg += f'\nGitHub version is not known yet, try again later.'
+    else:
+        version_msg += f'Github version is {github_version}\n'
+        if parse_version(bot_version) < parse_version(github_version):
+            version_msg += f'\nThere\'s a new version of the bot available at GitHub ({github_version})\nUpdate bot version following Wiki instructions.'
+        elif parse_version(bot_version) == parse_version(github_version):
+            version_msg += f'\nBot version is up to date'
+        else:
+            version_msg += f'\nLocal version is ahead of GitHub version.'
+    reply_text(update, version_msg)
 
 # internal callbacks
-def reboot_callback(query, reboot_time=5):
+def timer_to_config(entry) -> dict:
+    timer_config = {key : entry[key] for key in ("id", "label", "due", "owner", "chat_id", "message_id", "partition")}
+    if entry.get("schedule"):
+        timer_config.update({"schedule" : entry["schedule"]})
+    return timer_config
+
+def restore_timers(replace=False) -> None:
+    # load timers and alarms stored in config.json back into scheduler. Those which came due while
+    # the bot was down are handled by TIMERS.missed_policy: fire, coalesce or drop.
+    missed_policy = timers_data.get("missed_policy", "fire")
+    now = time.time()
+    entries = []
+    missed = {}
+    rescheduled = False
+    for kind, section in (('/timer', "timers"), ('/alarm', "alarms")):
+        for stored in timers_data.get(section, []):
+            if not isinstance(stored, dict):
+                logger.warning('Dropping %s %s stored without due time.', section, stored)
+                continue
+            entry = dict(stored)
+            entry.update({"kind" : kind})
+            # timers stored before chat partitions belong to the first allowed chat
+            entry.setdefault("partition", chat_partitions.default_chat)
+            if entry["due"] > now or missed_policy == "fire":
+                entries.append(entry)
+                continue
+            if missed_policy == "coalesce":
+                missed.setdefault(entry["chat_id"], []).append(entry)
+            else:
+                logger.info('Dropping %s %s missed while bot was down.', section, entry["label"])
+            # recurring alarms go on from their next time
+            next_due = timer_next_due(entry, now)
+            if next_due is not None:
+                entries.append(dict(entry, due=next_due))
+                rescheduled = True
+    timer_scheduler.load(entries, replace)
+    for missed_chat_id, missed_entries in missed.items():
+        missed_entries.sort(key=lambda entry: entry["due"])
+        missed_msg = join_words([f'{timers_dict.get(entry["kind"]).get("timer_name").lower()} {entry["label"]}' for entry in missed_entries])
+        try:
+            send_message(missed_chat_id, f'While the bot was offline these ended: {missed_msg}.', 'alarm')
+        except Exception:
+            logger.exception('Could not notify missed timers to chat %s', missed_chat_id)
+    if rescheduled or len(entries) != len(timers_data.get("timers", [])) + len(timers_data.get("alarms", [])):
+        state_store.save_timers(entries)
+
+def timer_fired(entry) -> None:
+    timer_stop_string = timers_dict.get(entry["kind"]).get('timer_stop')
+    send_message(entry["chat_id"], f'{entry["label"]} {timer_stop_string}', 'alarm', reply_to_message_id=entry["message_id"], allow_sending_without_reply=True)
+    # recurring alarms are still scheduled, with their next due time
+    if timer_scheduler.get(entry["id"]) is entry:
+        state_store.save_timer(entry)
+    else:
+        state_store.delete_timer(entry["id"])
+
+def reboot_callback(query, parsed_command, parsed_command_arg, from_user_id, chat_id) -> None:
+    reboot_time = 5 if parsed_command_arg is None else int(parsed_command_arg)
     query.edit_message_text(text=f'Rebooting in {reboot_time} secs...')
-    time.sleep(reboot_time)
-    os.system("sudo reboot")
+    # wait on a timer thread instead of sleeping on the handler thread
+    threading.Timer(reboot_time, os.system, args=["sudo reboot"]).start()
 
-def join_callback(query, parsed_command, from_user_id):
-    user_callback(query, parsed_command, from_user_id, None)
+def join_callback(query, parsed_command, parsed_command_arg, from_user_id, chat_id) -> None:
+    user_callback(query, parsed_command, from_user_id, None, chat_id)
 
-def user_callback(query, parsed_command, parsed_command_arg, from_user_id) -> None:
-    callback_answer = callback_dict.get(parsed_command)
+def user_callback(query, parsed_command, parsed_command_arg, from_user_id, chat_id) -> None:
+    if isinstance(parsed_command_arg, list):
+        bulk_user_callback(query, parsed_command, parsed_command_arg, from_user_id, chat_id)
+        return
+    parsed_command_arg = int(parsed_command_arg)
+    user_directory = chat_directory(chat_id)
+    change_error = user_change_error(user_directory, parsed_command, parsed_command_arg, from_user_id)
+    if change_error is not None:
+        query.edit_message_text(text=change_error)
+    else:
+        apply_user_change(user_directory, parsed_command, parsed_command_arg)
+        save_user_change(parsed_command_arg, chat_id)
+        query.edit_message_text(text=callback_dict.get(parsed_command))
+
+def bulk_user_callback(query, parsed_command, user_ids, from_user_id, chat_id) -> None:
+    # the batch is checked again, roles may have changed while waiting for confirmation
+    user_directory = chat_directory(chat_id)
+    with user_directory.lock:
+        valid_ids, skipped = check_user_changes(user_directory, parsed_command, user_ids, from_user_id)
+        for user_id in valid_ids:
+            apply_user_change(user_directory, parsed_command, user_id)
+    save_user_changes(valid_ids, chat_id)
+    bulk_question, bulk_answer = bulk_dict.get(parsed_command)
+    query.edit_message_text(text=bulk_answer.format(count=len(valid_ids)) + skipped_summary(skipped))
+
+def user_change_error(user_directory, parsed_command, user_id, from_user_id):
+    # reason why the command can't change the user, None if it can
     if parsed_command == '/adduser':
-        if parsed_command_arg in allowed_users:
-            query.edit_message_text(text=f'The user is already on allowed users list.')
-        elif parsed_command_arg in banned_users:
-            query.edit_message_text(text=f'The user is on banned users list. You must unban the user first.')
-        else:
-            allowed_users.append(parsed_command_arg)
-            users_data.update({"allowed_users" : allowed_users})
-            if parsed_command_arg in user_requests:
-                user_requests.remove(parsed_command_arg)
-                users_data.update({"user_requests" : user_requests})
-            config.update({"USERS" : users_data})
-            store_config(config)
-            read_config()
-            query.edit_message_text(text=callback_answer)
+        if user_directory.is_allowed(user_id):
+            return 'The user is already on allowed users list.'
+        elif user_directory.is_banned(user_id):
+            return 'The user is on banned users list. You must unban the user first.'
     elif parsed_command == '/removeuser':
-        if parsed_command_arg in bot_owner:
-            query.edit_message_text(text=f'The user is the owner of the bot, can\'t be kicked off.')
-        elif parsed_command_arg == from_user_id:
-            query.edit_message_text(text=f'Can\'t remove yourself from allowed users list.')
-        elif parsed_command_arg in admin_users:
-            query.edit_message_text(text=f'The user is an admin, can\'t be kicked off. You must remove the user from admins list first.')
-        elif parsed_command_arg not in allowed_users:
-            query.edit_message_text(text=f'The user is not in allowed users list.')
-        else:
-            allowed_users.remove(parsed_command_arg)
-            users_data.update({"allowed_users" : allowed_users})
-            config.update({"USERS" : users_data})
-            store_config(config)
-            read_config()
-            query.edit_message_text(text=callback_answer)
+        if user_directory.is_owner(user_id):
+            return 'The user is the owner of the bot, can\'t be kicked off.'
+        elif user_id == from_user_id:
+            return 'Can\'t remove yourself from allowed users list.'
+        elif user_directory.is_admin(user_id):
+            return 'The user is an admin, can\'t be kicked off. You must remove the user from admins list first.'
+        elif not user_directory.is_allowed(user_id):
+            return 'The user is not in allowed users list.'
     elif parsed_command == '/makeadmin':
-        if parsed_command_arg in admin_users:
-            query.edit_message_text(text=f'The user is already on admins list.')
-        if parsed_command_arg not in allowed_users:
-            query.edit_message_text(text=f'The user is not in allowed users list. You must add the user first.')
-        else:
-            admin_users.append(parsed_command_arg)
-            users_data.update({"admin_users" : admin_users})
-            config.update({"USERS" : users_data})
-            store_config(config)
-            read_config()
-            query.edit_message_text(text=callback_answer)
+        if user_directory.is_admin(user_id):
+            return 'The user is already on admins list.'
+        elif not user_directory.is_allowed(user_id):
+            return 'The user is not in allowed users list. You must add the user first.'
     elif parsed_command == '/revokeadmin':
-        if parsed_command_arg in bot_owner:
-            query.edit_message_text(text=f'The user is the owner of the bot, can\'t be removed from admins list.')
-        elif parsed_command_arg == from_user_id:
-            query.edit_message_text(text=f'Can\'t ban yourself from admins list.')
-        elif parsed_command_arg not in admin_users:
-            query.edit_message_text(text=f'The user is not in admins list.')
-        else:
-            admin_users.remove(parsed_command_arg)
-            users_data.update({"admin_users" : admin_users})
-            config.update({"USERS" : users_data})
-            store_config(config)
-            read_config()
-            query.edit_message_text(text=callback_answer)
+        if user_directory.is_owner(user_id):
+            return 'The user is the owner of the bot, can\'t be removed from admins list.'
+        elif user_id == from_user_id:
+            return 'Can\'t ban yourself from admins list.'
+        elif not user_directory.is_admin(user_id):
+            return 'The user is not in admins list.'
     elif parsed_command == '/banuser':
-        if parsed_command_arg in bot_owner:
-            query.edit_message_text(text=f'The user is the owner of the bot, can\'t be banned.')
-        elif parsed_command_arg == from_user_id:
-            query.edit_message_text(text=f'Can\'t ban yourself.')
-        elif parsed_command_arg in admin_users:
-            query.edit_message_text(text=f'The user is an admin. You must remove the user from admins list first.')
-        else:
-            if parsed_command_arg in allowed_users:
-                allowed_users.remove(parsed_command_arg)
-                users_data.update({"allowed_users" : allowed_users})
-            banned_users.append(parsed_command_arg)
-            users_data.update({"banned_users" : banned_users})
-            config.update({"USERS" : users_data})
-            store_config(config)
-            read_config()
-            query.edit_message_text(text=callback_answer)
+        if user_directory.is_owner(user_id):
+            return 'The user is the owner of the bot, can\'t be banned.'
+        elif user_id == from_user_id:
+            return 'Can\'t ban yourself.'
+        elif user_directory.is_admin(user_id):
+            return 'The user is an admin. You must remove the user from admins list first.'
+    elif parsed_command == '/unban':
+        if not user_directory.is_banned(user_id):
+            return 'The user is not in banned users list.'
+    elif parsed_command == '/dismiss':
+        if not user_directory.has('user_requests', user_id):
+            return 'The user has no pending request.'
+    return None
+
+def apply_user_change(user_directory, parsed_command, user_id) -> None:
+    if parsed_command == '/adduser':
+        user_directory.add('allowed_users', user_id)
+    elif parsed_command == '/removeuser':
+        user_directory.remove('allowed_users', user_id)
+    elif parsed_command == '/makeadmin':
+        user_directory.add('admin_users', user_id)
+    elif parsed_command == '/revokeadmin':
+        user_directory.remove('admin_users', user_id)
+    elif parsed_command == '/banuser':
+        user_directory.add('banned_users', user_id)
     elif parsed_command == '/unban':
-        banned_users.remove(parsed_command_arg)
-        users_data.update({"banned_users" : banned_users})
-        config.update({"USERS" : users_data})
-        store_config(config)
-        read_config()
-        query.edit_message_text(text=callback_answer)
+        user_directory.remove('banned_users', user_id)
     elif parsed_command == '/join':
-        user_requests.append(parsed_command_arg)
-        users_data.update({"user_requests" : user_requests})
-        config.update({"USERS" : users_data})
-        store_config(config)
-        read_config()
-        query.edit_message_text(text=callback_answer)
+        user_directory.add('user_requests', user_id)
     elif parsed_command == '/dismiss':
-        user_requests.remove(parsed_command_arg)
-        user_rejects.append(parsed_command_arg)
-        users_data.update({"user_requests" : user_requests})
-        users_data.update({"user_rejects" : user_rejects})
-        config.update({"USERS" : users_data})
-        store_config(config)
-        read_config()
-        query.edit_message_text(text=callback_answer)
+        user_directory.remove('user_requests', user_id)
+        user_directory.add('user_rejects', user_id)
+
+def check_user_changes(user_directory, parsed_command, user_ids, from_user_id):
+    # users of a batch that can be changed, and the others grouped by reason. Repeated ids count once
+    valid_ids = []
+    skipped = {}
+    for user_id in dict.fromkeys(user_ids):
+        change_error = user_change_error(user_directory, parsed_command, user_id, from_user_id)
+        if change_error is None:
+            valid_ids.append(user_id)
+        else:
+            skipped.setdefault(change_error, []).append(user_id)
+    return valid_ids, skipped
+
+def skipped_summary(skipped) -> str:
+    skipped_msg = ''
+    for change_error, user_ids in skipped.items():
+        shown_ids = ', '.join(str(user_id) for user_id in user_ids[:10])
+        if len(user_ids) > 10:
+            shown_ids += f' and {len(user_ids) - 10} more'
+        skipped_msg += f'\n{change_error} Skipped {shown_ids}.'
+    return '\n' + skipped_msg if skipped_msg else ''
+
+def save_user_change(user_id, chat_id) -> None:
+    save_user_changes([user_id], chat_id)
+
+def save_user_changes(user_ids, chat_id) -> None:
+    # one write to the state store for the whole batch
+    if len(user_ids) == 0:
+        return
+    state_store.save_users(user_ids, chat_id)
+    for user_id in user_ids:
+        member_cache.invalidate(chat_id, user_id)
+        chat_partitions.forget_home(user_id)
+        flood_control.forget(user_id, chat_id)
 
 # internal modules
-def check_chatmember(user_id) -> None:
-    if user_id not in allowed_users and user_id not in chat_members:
-        chat_members.append(user_id)
-        users_data.update({"chat_members" : chat_members})
-        config.update({"USERS" : users_data})
-        store_config(config)
-        read_config()
+def check_chatmember(user_id, chat_id) -> None:
+    user_directory = chat_directory(chat_id)
+    if not user_directory.is_allowed(user_id) and user_directory.add('chat_members', user_id):
+        state_store.save_users([user_id], chat_id)
 
 def command_parser(update: Update, context: CallbackContext) -> None:
     parsed_command_error = False
     parsed_message = update.message
-    chat_info = update.message['chat']
-    user_id = int(chat_info['id'])
+    user_id = int(parsed_message.from_user.id)
+    chat_id = chat_partitions.route(parsed_message)
     parsed_text = parsed_message['text']
     striped_text = parsed_text.strip()
     splitted_text = striped_text.split()
-    if len(splitted_text) > 2:
-        update.message.reply_markdown_v2('The command is malformed\. The correct format is _/command \*argument_\.')
+    if len(splitted_text) > 1 and splitted_text[0] in text_arg_commands:
+        parsed_command = splitted_text[0]
+        parsed_command_arg = striped_text[len(parsed_command):].strip()
+    elif len(splitted_text) == 3 and splitted_text[1] in multi_arg_dict.get(splitted_text[0], []):
+        parsed_command = splitted_text[0]
+        parsed_command_arg = ' '.join(splitted_text[1:])
+    elif len(splitted_text) > 2:
+        reply_markdown_v2(update, 'The command is malformed\. The correct format is _/command \*argument_\.')
         parsed_command = parsed_command_arg = None
         parsed_command_error = True
     elif len(splitted_text) == 1:
@@ -572,37 +2840,46 @@ def command_parser(update: Update, context: CallbackContext) -> None:
     return parsed_command, parsed_command_arg, parsed_command_error, user_id, chat_id
 
 def users_list(update: Update, parsed_command, chat_id) -> None:
+    user_directory = chat_directory(chat_id)
+    render_key = (parsed_command, chat_id, user_directory.version)
+    users_list_msg = render_cache.get(render_key)
+    if users_list_msg is not None:
+        return users_list_msg
     users_list_msg = pre = post = post_id = ""
+    cacheable = True
     if parsed_command == '/listusers':
-        method_list = allowed_users
+        method_list = user_directory.users('allowed_users')
     elif parsed_command == '/adminusers':
-        method_list = admin_users
+        method_list = user_directory.users('admin_users')
     elif parsed_command == '/chatmembers':
-        method_list = allowed_users + chat_members
+        method_list = user_directory.chat_members()
     elif parsed_command == '/requests':
-        method_list = user_requests
+        method_list = user_directory.users('user_requests')
     elif parsed_command == '/banlist':
-        method_list = banned_users
+        method_list = user_directory.users('banned_users')
     if len(method_list) == 0:
         users_list_msg += f"List is empty\."
     else:
-        for n in range(0, len(method_list)):
-            user_info = bot.getChatMember(chat_id=chat_id, user_id=method_list[n])
-            user = user_info["user"]
+        profiles = member_cache.get_many(chat_id, method_list, fetch_member)
+        for member_id in method_list:
+            user = profiles[member_id]
+            # don't keep listings with profiles that couldn't be fetched
+            if user.get("missing"):
+                cacheable = False
             user_id = user["id"]
-            username = user["username"]
-            first_name = user["first_name"]
-            last_name = user["last_name"]
-            if parsed_command == '/adminusers' and user_id not in admin_users:
+            username = markdown_escape(user["username"]) if user["username"] is not None else None
+            first_name = markdown_escape(user["first_name"])
+            last_name = markdown_escape(user["last_name"] or '')
+            if parsed_command == '/adminusers' and not user_directory.is_admin(user_id):
                 pass
             else:
-                if user_id in admin_users:
+                if user_directory.is_admin(user_id):
                     pre = post = '_'
                     if parsed_command == "/listusers" or parsed_command == "/chatmembers":
                         post_id = '\*'
                 else:
                     pre = post = ''
-                    if parsed_command == "/chatmembers" and user_id in allowed_users:
+                    if parsed_command == "/chatmembers" and user_directory.is_allowed(user_id):
                         post_id = "\+"
                     elif parsed_command == "/chatmembers" and user_id == bot_id:
                         post_id = "\@"
@@ -616,95 +2893,424 @@ def users_list(update: Update, parsed_command, chat_id) -> None:
             users_list_msg += '\n\* admins'
         if parsed_command == "/chatmembers":
             users_list_msg += '\n\+ allowed users\n\@ bot'
+    if cacheable:
+        render_cache.put(render_key, users_list_msg)
     return users_list_msg
 
+def fetch_member(chat_id, user_id) -> dict:
+    user_info = stats.timed('api', 'getChatMember', bot.getChatMember, chat_id=chat_id, user_id=user_id)
+    user = user_info["user"]
+    return {"id" : user["id"], "username" : user["username"], "first_name" : user["first_name"], "last_name" : user["last_name"]}
+
+def join_words(words) -> str:
+    if len(words) < 2:
+        return ''.join(words)
+    return ', '.join(words[:-1]) + ' and ' + words[-1]
+
 def keyboard_construct(keyboard_name):
     buttons = []
     for key, label in keyboard_dict[keyboard_name].items():
         buttons.append(InlineKeyboardButton(text=label, callback_data=key))
     return InlineKeyboardMarkup([buttons])
 
+def ask_confirmation(update: Update, parsed_command, parsed_command_arg, chat_id, confirm_text='Are you sure?') -> None:
+    keyboard_markup = keyboard_construct('yes_no')
+    requester_id = update.message.from_user.id
+    def confirm_sent(future) -> None:
+        if future.exception() is None:
+            confirm_message = future.result()
+            pending_confirmations.add((confirm_message.chat_id, confirm_message.message_id), requester_id, parsed_command, parsed_command_arg, chat_id)
+    reply_text(update, confirm_text, reply_markup=keyboard_markup).add_done_callback(confirm_sent)
+
 def keyboard_query(update: Update, context: CallbackContext) -> None:
     query = update.callback_query
-    answer = query.answer()
     query_answer = query.data
     from_user = query.from_user
     from_user_id = from_user["id"]
-    while answer == False:
-        continue
-    else:
-        if query_answer == "y":
-            if parsed_command == '/reboot':
-                if parsed_command_arg == None:
-                    reboot_callback(query)
-                else:
-                    reboot_callback(query, parsed_command_arg)
-            elif parsed_command == '/join':
-                join_callback(query, parsed_command, from_user_id)
-            elif parsed_command == '/adduser' or parsed_command == '/removeuser' or parsed_command == '/makeadmin' or parsed_command == '/revokeadmin' or parsed_command == '/dismiss' or parsed_command == '/banuser' or parsed_command == '/unban' :
-                user_callback(query, parsed_command, int(parsed_command_arg), from_user_id)
-        elif query_answer == "n":
-            if parsed_command == '/reboot':
-                query.edit_message_text(text=f'Reboot aborted.')
-            else:
-                query.edit_message_text(text=f'Command aborted.')
+    confirm_key = (query.message.chat_id, query.message.message_id)
+    confirmation = pending_confirmations.get(confirm_key)
+    if confirmation is not None and confirmation["user_id"] != from_user_id:
+        query.answer(text='Only the user who sent the command can answer this.')
+        return
+    query.answer()
+    # pop again so two quick taps can't run the same command twice
+    if confirmation is None or pending_confirmations.pop(confirm_key) is None:
+        query.edit_message_text(text='This confirmation has expired, send the command again.')
+        return
+    parsed_command = confirmation["command"]
+    parsed_command_arg = confirmation["arg"]
+    chat_id = confirmation["chat_id"]
+    command_entry = command_dict.get(parsed_command)
+    if query_answer == "y":
+        if not run_on_pool(command_entry["pool"], stats.timed, 'confirm', parsed_command, command_entry["confirm"], query, parsed_command, parsed_command_arg, from_user_id, chat_id):
+            query.edit_message_text(text=pool_busy_text)
+    elif query_answer == "n":
+        query.edit_message_text(text=command_entry["abort"])
 
-def store_config(json_config) -> None:
-    file = open('config.json', 'w')
-    file.write(json.dumps(json_config, indent=2))
-    file.close()
+def config_snapshot() -> dict:
+    # USERS and TIMERS sections are rebuilt by the state store, or left out when it's a database
+    json_config = dict(config)
+    state_store.config_sections(json_config)
+    return json_config
+
+def store_config() -> None:
+    # queue a background write when the writer is running, otherwise write right away
+    if config_writer is not None:
+        config_writer.mark_dirty()
+    else:
+        stats.timed('config', 'write', write_config, config_file, config_snapshot)
 
 def read_config() -> None:
-    global config, bot_data, bot_token, bot_id, bot_version, users_data, allowed_users, admin_users, bot_owner, chat_members, user_requests, user_rejects, banned_users, chats_data, chat_id, timers_data, timers, alarms
-    file = open('config.json', 'r')
+    global chat_partitions
+    file = open(config_file, 'r')
     json_data = file.read()
     file.close()
 
-    config = json.loads(json_data)
+    load_config(json.loads(json_data))
+    chat_partitions = ChatPartitions(allowed_chats, chats_data.get("max_active", 64))
 
-    config = json.loads(json_data)
+def load_config(new_config) -> None:
+    global config, bot_data, bot_token, bot_id, bot_version, users_data, chats_data, allowed_chats, timers_data, persistence_data, write_delay, cache_data, system_data, version_data, confirmations_data, engine_data, updates_data, outbound_data, events_data, rules_data, stats_data, storage_data, flood_data, workers_data
+    config = new_config
     bot_data = config.get("BOT_DATA")
-    users_data = config.get("USERS")
+    users_data = config.get("USERS", {})
     chats_data = config.get("CHATS")
     timers_data = config.get("TIMERS")
     bot_token = bot_data.get("bot_token")
     bot_id = bot_data.get("bot_id")
     bot_version = bot_data.get("bot_version")
-    allowed_users = users_data.get("allowed_users")
-    admin_users = users_data.get("admin_users")
-    bot_owner = users_data.get("bot_owner")
-    chat_members = users_data.get("chat_members")
-    user_requests = users_data.get("user_requests")
-    user_rejects = users_data.get("user_rejects")
-    banned_users = users_data.get("banned_users")
-    chat_id = chats_data.get("allowed_chats")
-    timers = timers_data.get("timers")
-    alarms = timers_data.get("alarms")
+    # CHATS.allowed_chats may be a single chat id or a list of them, users of each chat are loaded on first use
+    allowed_chats = chats_data.get("allowed_chats")
+    if not isinstance(allowed_chats, list):
+        allowed_chats = [allowed_chats]
+    persistence_data = config.get("PERSISTENCE", {})
+    write_delay = persistence_data.get("write_delay", 1.0)
+    cache_data = config.get("CACHE", {})
+    system_data = config.get("SYSTEM", {})
+    version_data = config.get("VERSION_CHECK", {})
+    confirmations_data = config.get("CONFIRMATIONS", {})
+    engine_data = config.get("ENGINE", {})
+    updates_data = config.get("UPDATES", {})
+    outbound_data = config.get("OUTBOUND", {})
+    events_data = config.get("EVENTS", {})
+    rules_data = config.get("RULES", [])
+    stats_data = config.get("STATS", {})
+    storage_data = config.get("STORAGE", {})
+    flood_data = config.get("FLOOD", {})
+    workers_data = config.get("WORKERS", {})
+
+def reload_config(new_config) -> None:
+    # apply the sections of a hand edited config.json that differ from in-memory config
+    with config_lock:
+        current_config = config_snapshot()
+        changed_sections = [section for section in new_config if new_config.get(section) != current_config.get(section)]
+        changed_sections += [section for section in current_config if section not in new_config]
+        if len(changed_sections) == 0:
+            return
+        if not state_store.file_sections and "USERS" in new_config:
+            logger.warning('Users are kept in %s, ignoring USERS section of %s', storage_data.get("path", 'smarthomebot.db'), config_file)
+        load_config(new_config)
+        logger.info('Reloading %s sections of %s', ', '.join(changed_sections), config_file)
+        reload_handlers = []
+        for section in changed_sections:
+            reload_handler = config_reload_dict.get(section)
+            if reload_handler is None:
+                logger.warning('Changes to %s section take effect after a restart', section)
+            elif reload_handler not in reload_handlers:
+                reload_handlers.append(reload_handler)
+        for reload_handler in reload_handlers:
+            reload_handler()
+
+def reload_chats() -> None:
+    # role lists or chats changed, directories are loaded again from the new sections on first use
+    global chat_partitions
+    for partition_chat, directory in chat_partitions.loaded():
+        member_cache.invalidate(partition_chat)
+    chat_partitions = ChatPartitions(allowed_chats, chats_data.get("max_active", 64))
+    flood_control.forget()
+
+def reload_timers() -> None:
+    # timers and alarms only live in config.json with json backend
+    if state_store.file_sections:
+        restore_timers(replace=True)
+
+def reload_persistence() -> None:
+    config_writer.write_delay = write_delay
+
+def reload_caches() -> None:
+    member_cache.ttl = render_cache.ttl = cache_data.get("member_ttl", 3600)
+    member_cache.max_size = cache_data.get("member_cache_size", 1024)
+    member_cache.workers = cache_data.get("member_fetch_workers", 4)
+    render_cache.max_size = cache_data.get("render_cache_size", 256)
+
+def reload_confirmations() -> None:
+    pending_confirmations.ttl = confirmations_data.get("ttl", 300)
+    pending_confirmations.max_size = confirmations_data.get("max_pending", 256)
+
+def reload_flood_control() -> None:
+    flood_control.configure(flood_data.get("rate", 1), flood_data.get("burst", 5), flood_data.get("reject_ttl", 600), flood_data.get("ban_after", 20), flood_data.get("ban_window", 60), flood_data.get("ban_time", 3600), flood_data.get("max_users", 4096))
+
+def reload_outbound() -> None:
+    outbound_queue.configure(outbound_data.get("global_rate", 30), outbound_data.get("chat_rate", 1), outbound_data.get("group_rate", 20/60), outbound_data.get("burst", 3), outbound_data.get("max_retries", 5), outbound_data.get("max_chats", 4096))
+
+def reload_rules() -> None:
+    # rules are compiled again, so active rules start over
+    global rule_engine
+    new_rule_engine = RuleEngine(rules_data, notify=notify_chats)
+    system_sampler.listeners[system_sampler.listeners.index(rule_engine.feed_sample)] = new_rule_engine.feed_sample
+    rule_engine = new_rule_engine
+
+config_reload_dict = {
+    'USERS' : reload_chats,
+    'CHATS' : reload_chats,
+    'TIMERS' : reload_timers,
+    'PERSISTENCE' : reload_persistence,
+    'CACHE' : reload_caches,
+    'CONFIRMATIONS' : reload_confirmations,
+    'FLOOD' : reload_flood_control,
+    'OUTBOUND' : reload_outbound,
+    'RULES' : reload_rules
+}
+
+# command registry
+# every command declares its handler, required role, argument schema and help text. Dispatch is a
+# single dict lookup, arguments are validated before the handler runs, and help pages are built once.
+command_dict = {}
+arg_dict = {
+    'none' : (lambda arg: arg is None, ''),
+    'optional' : (lambda arg: True, '[argument]'),
+    'user_id' : (lambda arg: arg is not None and arg.isdigit(), 'user_id'),
+    'user_ids' : (lambda arg: parse_user_ids(arg) is not None, 'user_id [user_id ...]'),
+    'secs' : (lambda arg: arg is None or arg.isdigit(), '[secs]'),
+    'text' : (lambda arg: arg is not None and arg != '', 'message')
+}
+
+def register_command(command, handler, role, arg, help_text, choices=None, usage=None, confirm=None, abort='Command aborted.', pool=None) -> None:
+    # commands with a pool run there, with their confirmation callback, others on dispatcher thread
+    command_dict[command] = {
+        "handler" : handler,
+        "role" : role,
+        "arg" : arg,
+        "choices" : choices,
+        "help" : help_text,
+        "usage" : usage or [],
+        "confirm" : confirm,
+        "abort" : abort,
+        "pool" : pool
+    }
+
+def check_argument(command_entry, parsed_command_arg) -> bool:
+    if command_entry["choices"] is not None and parsed_command_arg is not None:
+        return parsed_command_arg in command_entry["choices"]
+    arg_check, arg_usage = arg_dict.get(command_entry["arg"])
+    return arg_check(parsed_command_arg)
+
+def command_usage(command) -> str:
+    command_entry = command_dict.get(command)
+    if command_entry["choices"] is not None:
+        return f'{command} [{"|".join(command_entry["choices"])}]'
+    arg_check, arg_usage = arg_dict.get(command_entry["arg"])
+    return f'{command} {arg_usage}'.strip()
+
+def markdown_escape(text) -> str:
+    return str(text).translate(markdown_escape_table)
+
+def build_help_page(title, lines, header='', footer='') -> str:
+    help_page = f'\n{markdown_escape(header)}\n\n' if header else '\n'
+    help_page += f'*{markdown_escape(title)}*\n'
+    for usage, help_text in lines:
+        help_page += f'`{usage}` \\- {markdown_escape(help_text)}\n'
+    if footer:
+        help_page += f'\n{markdown_escape(footer)}\n'
+    return help_page
+
+def build_help_pages() -> dict:
+    pages = {
+        'user' : build_help_page('Available commands', [(command, entry["help"]) for command, entry in command_dict.items() if entry["role"] == 'user'],
+            header='This is a simple Telegram Bot used to automate notifications for a Smart Home.',
+            footer='For admin restricted commands use /admincommands.'),
+        'admin' : build_help_page('Admin restricted commands', [(command, entry["help"]) for command, entry in command_dict.items() if entry["role"] == 'admin'],
+            footer='Commands taking user_id also take several ids, or a CSV file of ids sent with the command as caption.\n* Available only in Linux')
+    }
+    # commands with several usages get their own page, e.g. /help timer
+    for command, entry in command_dict.items():
+        if entry["usage"]:
+            pages[command.lstrip('/')] = build_help_page(f'{command.lstrip("/").capitalize()} help', entry["usage"])
+    return pages
+
+register_command('/start', start_command, 'user', 'none', 'Does nothing, bot starts automatically.')
+register_command('/help', help_command, 'user', 'none', 'Shows a list of all available commands.', choices=['timer', 'alarm'])
+register_command('/listusers', listusers_command, 'user', 'none', 'List all users allowed to use this bot.', pool='io')
+register_command('/adminusers', listusers_command, 'user', 'none', 'List all users with admin capabilities.', pool='io')
+register_command('/chatmembers', listusers_command, 'user', 'none', 'List members of the chat, including allowed users, admins and bot.', pool='io')
+register_command('/join', join_command, 'user', 'none', 'Lets users ask an admin to approve them into allowed users list.', confirm=join_callback, pool='admin')
+register_command('/time', time_command, 'user', 'none', 'Display local time.')
+register_command('/timer', timer_command, 'user', 'optional', 'Sets a timer and notifies when it\'s over.', usage=[
+    ('/timer', 'Checks if there are any configured timers.'),
+    ('/timer hh:mm', 'Sets a timer for hh hours and mm minutes. hh must be above 0, and mm must be between 0 and 59.'),
+    ('/timer xxxs', 'Sets a timer for xxx seconds. Value can be greater than 59 seconds and you must use integers.'),
+    ('/timer xxxm', 'Sets a timer for xxx minutes. Value can be greater than 59 minutes and you must use integers.'),
+    ('/timer xxxh', 'Sets a timer for xxx hours. Value can be greater than 23 hours and you must use integers.'),
+    ('/timer cancel id', 'Cancels the timer with that id. Only its owner or an admin can cancel it.')
+])
+register_command('/alarm', timer_command, 'user', 'optional', 'Sets an alarm and notifies when it\'s over.', usage=[
+    ('/alarm', 'Checks if there are any configured alarms.'),
+    ('/alarm hh:mm', 'Sets an alarm for hh hour and mm minutes in 24 hour format. hh must be between 0 and 23, and mm must be between 0 and 59.'),
+    ('/alarm daily hh:mm', 'Sets an alarm every day at hh:mm.'),
+    ('/alarm weekdays hh:mm', 'Sets an alarm from Monday to Friday at hh:mm.'),
+    ('/alarm weekends hh:mm', 'Sets an alarm on Saturday and Sunday at hh:mm.'),
+    ('/alarm cron m h day month weekday', 'Sets a recurring alarm with a cron expression, e.g. /alarm cron 30 7 * * 1-5. Weekday 0 is Sunday.'),
+    ('/alarm cancel id', 'Cancels the alarm with that id. Only its owner or an admin can cancel it.')
+])
+register_command('/admincommands', help_admin_command, 'admin', 'none', 'Shows available commands for admin users.')
+register_command('/requests', requests_command, 'admin', 'none', 'Let admins check pending requests to join allowed users list, and approve or dismiss them. Use /requests approve all or /requests dismiss all for every pending request.', choices=['approve all', 'dismiss all'], pool='io')
+register_command('/dismiss', dismiss_command, 'admin', 'user_ids', 'Dismiss a request for joining allowed users list. Remember to add user_id argument.', confirm=user_callback, pool='admin')
+register_command('/adduser', anyuser_command, 'admin', 'user_ids', 'Add a user to allowed users list with user_id argument.', confirm=user_callback, pool='admin')
+register_command('/removeuser', anyuser_command, 'admin', 'user_ids', 'Remove a user from allowed users list with user_id argument. Bot owner can\'t be banned.', confirm=user_callback, pool='admin')
+register_command('/banuser', anyuser_command, 'admin', 'user_ids', 'Add a user to banned users list so he can\'t request joining allowed users list. Remember to add user_id argument.', confirm=user_callback, pool='admin')
+register_command('/unban', anyuser_command, 'admin', 'user_ids', 'Remove a user from banned users list. Remember to add user_id argument.', confirm=user_callback, pool='admin')
+register_command('/makeadmin', anyuser_command, 'admin', 'user_ids', 'Add a user to admins list with user_id argument.', confirm=user_callback, pool='admin')
+register_command('/revokeadmin', anyuser_command, 'admin', 'user_ids', 'Remove a user from admins list with user_id argument. Bot owner can\'t be removed.', confirm=user_callback, pool='admin')
+register_command('/banlist', listusers_command, 'admin', 'none', 'List all users banned from using the bot. This users can\'t use join command.', pool='io')
+register_command('/rules', rules_command, 'admin', 'none', 'List alert rules, their state and how many times they fired.')
+register_command('/broadcast', broadcast_command, 'admin', 'text', 'Sends a message to all allowed users.', pool='admin')
+register_command('/stats', stats_command, 'admin', 'none', 'Shows calls, errors and latency of handlers, commands, Bot API calls and config writes, and messages dropped by flood control.')
+register_command('/version', version_command, 'admin', 'none', 'Shows version of the installed bot instance.', pool='io')
+register_command('/system', system_command, 'admin', 'optional', 'Shows CPU temp*, CPU, RAM load and disk usage. Use /system history [minutes] for min, avg and max over the last minutes, 60 by default.', pool='sampling')
+register_command('/reboot', reboot_command, 'admin', 'secs', 'Reboots system. Default delay time is 5 secs. You can configure delay time as an argument.', confirm=reboot_callback, abort='Reboot aborted.', pool='admin')
+help_pages = build_help_pages()
 
 # main module
 def main() -> None:
-    global updater, dispatcher, bot
+    global updater, dispatcher, bot, config_writer, member_cache, render_cache, timer_scheduler, system_sampler, release_checker, pending_confirmations, run_async, webhook_server, outbound_queue, event_aggregator, event_server, rule_engine, stats_exporter, stats_server, state_store, timers_data, flood_control, config_watcher
     read_config()
 
-    # create the Updater and pass it your bot's token
-    updater = Updater(bot_token)
+    # users and timers may live in a database, migrated from config.json on first run
+    state_store = open_state_store()
+    timers_data = state_store.load(timers_data)
+    member_cache = MemberCache(cache_data.get("member_ttl", 3600), cache_data.get("member_cache_size", 1024), cache_data.get("member_fetch_workers", 4))
+    render_cache = RenderCache(cache_data.get("member_ttl", 3600), cache_data.get("render_cache_size", 256))
+    pending_confirmations = ConfirmationStore(confirmations_data.get("ttl", 300), confirmations_data.get("max_pending", 256))
+
+    # start background writer for config.json
+    config_writer = ConfigWriter(config_file, config_snapshot, write_delay)
+    config_writer.start()
+    # drop migrated sections from config.json
+    if not state_store.file_sections and ("USERS" in config or "chat_users" in chats_data or config.get("TIMERS", {}).keys() & {"timers", "alarms"}):
+        store_config()
+
+    # create the Updater and pass it your bot's token, its workers run handlers when run_async is set
+    run_async = engine_data.get("mode", "threaded") in engine_modes
+    updater = Updater(bot_token, workers=engine_data.get("max_concurrent_updates", 8) if run_async else 4)
     dispatcher = updater.dispatcher
     bot = Bot(bot_token)
 
+    # rate limited queue for outgoing messages
+    outbound_queue = OutboundQueue(bot, outbound_data.get("global_rate", 30), outbound_data.get("chat_rate", 1), outbound_data.get("group_rate", 20/60), outbound_data.get("burst", 3), outbound_data.get("max_retries", 5), outbound_data.get("workers", 4), outbound_data.get("max_chats", 4096))
+    outbound_queue.start()
+
+    # single thread scheduler for timers and alarms
+    timer_scheduler = TimerScheduler(timer_fired, timer_next_due)
+    restore_timers()
+    timer_scheduler.start()
+
+    # background sampler for /system
+    system_sampler = SystemSampler(system_data.get("sample_interval", 10), system_data.get("history_size", 360), system_data.get("disk_path", '/'))
+    rule_engine = RuleEngine(rules_data, notify=notify_chats)
+    system_sampler.listeners.append(rule_engine.feed_sample)
+
+    # background check of latest GitHub release for /version
+    release_checker = ReleaseChecker(version_data.get("endpoint", github_releases_url), version_data.get("interval", 21600), version_data.get("timeout", 10), version_data.get("offline", False))
+
+    # local endpoint for smart home events
+    if events_data.get("enabled", False):
+        event_aggregator = EventAggregator(events_data.get("dedup_window", 60), events_data.get("coalesce_window", 5))
+        event_aggregator.start()
+        event_server = EventServer(event_aggregator, events_data.get("listen", '127.0.0.1'), events_data.get("port", 8444), events_data.get("path", '/events'), events_data.get("token", ''))
+        event_server.start()
+
+    # handler stats export as Prometheus text, to a file and/or a local endpoint
+    if stats_data.get("prometheus_file"):
+        stats_exporter = StatsExporter(stats_data.get("prometheus_file"), stats_data.get("export_interval", 60))
+        stats_exporter.start()
+    if stats_data.get("endpoint_enabled", False):
+        stats_server = StatsServer(stats_data.get("listen", '127.0.0.1'), stats_data.get("port", 9464), stats_data.get("path", '/metrics'))
+        stats_server.start()
+
+    # per user rate limit of incoming messages
+    flood_control = FloodControl(flood_data.get("rate", 1), flood_data.get("burst", 5), flood_data.get("reject_ttl", 600), flood_data.get("ban_after", 20), flood_data.get("ban_window", 60), flood_data.get("ban_time", 3600), flood_data.get("max_users", 4096))
+    stats.collectors.append(flood_control.prometheus)
+
+    # bounded pools for commands that would hold up dispatcher threads
+    for pool_name, pool_defaults in pool_dict.items():
+        pool_data = dict(pool_defaults, **workers_data.get(pool_name, {}))
+        worker_pools[pool_name] = WorkerPool(pool_name, pool_data["workers"], pool_data["max_queue"])
+    stats.collectors.append(pool_prometheus)
+
+    # flood control admits messages on dispatcher thread before any other handler
+    dispatcher.add_handler(MessageHandler(Filters.all, admit_message), group=-1)
+
     # not allowed users can't interact with the bot
-    dispatcher.add_handler(MessageHandler(Filters.user(banned_users), not_allowed_users))
-    dispatcher.add_handler(MessageHandler(~Filters.user(allowed_users), not_allowed_users))
+    dispatcher.add_handler(MessageHandler(RoleFilter('banned_users'), engine_handler(not_allowed_users), run_async=run_async))
+    dispatcher.add_handler(MessageHandler(~RoleFilter('allowed_users'), engine_handler(not_allowed_users), run_async=run_async))
+
+    # CSV files of user ids for bulk user management
+    dispatcher.add_handler(MessageHandler(Filters.document & Filters.caption_regex(r'^/'), engine_handler(document_command), run_async=run_async))
 
     # on non command i.e message, reply with not_command function
-    dispatcher.add_handler(MessageHandler(~Filters.command, not_command))
-    dispatcher.add_handler(MessageHandler(Filters.command, check_command))
+    dispatcher.add_handler(MessageHandler(~Filters.command, engine_handler(not_command), run_async=run_async))
+    dispatcher.add_handler(MessageHandler(Filters.command, engine_handler(check_command), run_async=run_async))
 
     # inline buttons
-    dispatcher.add_handler(CallbackQueryHandler(keyboard_query))
+    dispatcher.add_handler(CallbackQueryHandler(engine_handler(keyboard_query), run_async=run_async))
   
-    # start the bot
-    updater.start_polling()
+    # start the bot, polling Telegram or receiving updates through webhook
+    if updates_data.get("mode", "polling") == "webhook":
+        webhook_server = WebhookServer(bot, dispatcher, updater.update_queue, updates_data.get("listen", '127.0.0.1'), updates_data.get("port", 8443), updates_data.get("path", '/telegram'), updates_data.get("secret_token", ''), updates_data.get("process_inline", False))
+        webhook_server.start()
+        if updates_data.get("url"):
+            bot.set_webhook(url=updates_data.get("url"), api_kwargs={"secret_token" : updates_data.get("secret_token", '')})
+        updater.job_queue.start()
+        dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True)
+        dispatcher_thread.start()
+        updater.running = True
+    else:
+        updater.start_polling()
+    startup_time = time.perf_counter() - startup_started
+    stats.observe('startup', 'imports', startup_imported - startup_started)
+    stats.observe('startup', 'receiving updates', startup_time)
+    logger.info('Receiving updates %.2f secs after start, %.2f secs of them importing modules', startup_time, startup_imported - startup_started)
+
+    # sampler and release checker load their heavy modules, start them once updates flow
+    system_sampler.start()
+    release_checker.start()
+
+    # apply hand edits of config.json while running
+    if persistence_data.get("watch", True):
+        config_watcher = ConfigWatcher(config_file, reload_config, persistence_data.get("watch_interval", 5))
+        config_watcher.start()
     updater.idle()
+    if webhook_server is not None:
+        webhook_server.stop()
+
+    # write pending changes before exiting
+    if event_server is not None:
+        event_server.stop()
+        event_aggregator.stop()
+    for pool in worker_pools.values():
+        pool.stop()
+    if stats_server is not None:
+        stats_server.stop()
+    if stats_exporter is not None:
+        stats_exporter.stop()
+    if config_watcher is not None:
+        config_watcher.stop()
+    release_checker.stop()
+    system_sampler.stop()
+    timer_scheduler.stop()
+    outbound_queue.stop()
+    config_writer.stop()
+    state_store.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# SmartHomeBot webhook client
+# Posts recorded Telegram updates to the local webhook server of SmartHomeBot and measures handling latency.
+# Set UPDATES.process_inline to true in config.json so each request returns after its update is handled.
+#
+# Usage:
+# python webhook_client.py updates.json --url http://127.0.0.1:8443/telegram --secret secret-token --repeat 10
+
+import argparse, json, time, urllib.request, urllib.error
+
+def load_updates(path) -> list:
+    # accepts a single update, a list of updates or one update per line
+    file = open(path, 'r')
+    json_data = file.read()
+    file.close()
+    try:
+        updates = json.loads(json_data)
+    except ValueError:
+        updates = [json.loads(line) for line in json_data.splitlines() if line.strip()]
+    if isinstance(updates, dict):
+        updates = [updates]
+    return updates
+
+def post_update(url, secret, update) -> float:
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), method='POST')
+    request.add_header('Content-Type', 'application/json')
+    if secret:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+def percentile(values, percent) -> float:
+    index = min(len(values) - 1, round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Post recorded updates to SmartHomeBot webhook and measure latency.')
+    parser.add_argument('updates', help='JSON file with an update, a list of updates or one update per line')
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    parser.add_argument('--secret', default='')
+    parser.add_argument('--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    updates = load_updates(args.updates)
+    latencies = []
+    errors = 0
+    for n in range(args.repeat):
+        for update in updates:
+            try:
+                latencies.append(post_update(args.url, args.secret, update))
+            except urllib.error.URLError as error:
+                errors += 1
+                print(f'Update {update.get("update_id")} failed: {error}')
+    if len(latencies) == 0:
+        print('No update was handled.')
+        return
+    latencies.sort()
+    print(f'Updates handled: {len(latencies)}, errors: {errors}')
+    print(f'Latency ms: avg {sum(latencies) / len(latencies) * 1000:.2f}, p50 {percentile(latencies, 50) * 1000:.2f}, p95 {percentile(latencies, 95) * 1000:.2f}, max {latencies[-1] * 1000:.2f}')
+
+if __name__ == '__main__':
+    main()